@@ -1,22 +1,87 @@
 import argparse
 import sys
+import os
+import glob
+import hashlib
 import time
 import sqlite3
 import json
+import shutil
+import cProfile
+import pickle
+from NotifPayload import decode_payload
+from NotifCarver import carve_db
+from NotifWAL import read_wal
+from NotifExport import export_sqlite, export_parquet
+from NotifMetrics import Metrics, NO_METRICS
+from NotifRecords import HandlerRecord, NotificationRecord, to_json
+from NotifDedup import DedupIndex, dedup_assets, dedup_records
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from urllib.request import pathname2url
 
 PRAGMA_USER_VERSION = 'PRAGMA user_version'
 USER_VERSION = 'user_version'
-QUERY_ASSETS = 'SELECT RecordId, PrimaryId, nh.ParentId, AssetKey, AssetValue, WNSId, HandlerType, WNFEventName, \
-                    SystemDataPropertySet, nh.CreatedTime, nh.ModifiedTime, n.Payload, n.Type, n.ArrivalTime, \
-                    n.PayloadType, n.ExpiryTime \
-                FROM NotificationHandler nh  \
-                LEFT JOIN HandlerAssets ha ON ha.HandlerId = nh.RecordId \
-                LEFT JOIN Notification n ON nh.RecordId = n.HandlerId \
+QUERY_HANDLERS = 'SELECT RecordId, PrimaryId, ParentId, WNSId, HandlerType, WNFEventName, SystemDataPropertySet, \
+                    CreatedTime, ModifiedTime \
+                FROM NotificationHandler \
                 ORDER BY RecordId'
+QUERY_HANDLER_ASSETS = 'SELECT HandlerId, AssetKey, AssetValue FROM HandlerAssets'
+QUERY_NOTIFICATIONS = 'SELECT HandlerId, Payload, Type, ArrivalTime, PayloadType, ExpiryTime FROM Notification'
+QUERY_NOTIFICATION_ROWS = 'SELECT rowid AS RowId, HandlerId, Payload, Type, ArrivalTime, PayloadType, ExpiryTime \
+                FROM Notification'
+QUERY_NOTIFICATIONS_SINCE = QUERY_NOTIFICATION_ROWS + ' WHERE rowid > ? OR ArrivalTime > ?'
+QUERY_NOTIFICATION_RANGE = QUERY_NOTIFICATION_ROWS + ' WHERE rowid >= ? AND rowid < ?'
+QUERY_FINGERPRINT_ROWS = 'SELECT rowid, HandlerId, Payload, Type, ArrivalTime, PayloadType, ExpiryTime \
+                FROM Notification ORDER BY rowid'
+QUERY_WATERMARKS = 'SELECT (SELECT MAX(RecordId) FROM NotificationHandler) AS RecordId, \
+                    (SELECT MAX(ModifiedTime) FROM NotificationHandler) AS ModifiedTime, \
+                    (SELECT MAX(rowid) FROM Notification) AS NotificationRowId, \
+                    (SELECT MAX(ArrivalTime) FROM Notification) AS ArrivalTime'
 ASSETS = "assets"
+RECORD_TYPE = "RecordType"
+FORMAT_JSON = "json"
+FORMAT_NDJSON = "ndjson"
+FORMAT_SQLITE = "sqlite"
+FORMAT_PARQUET = "parquet"
+EXTENSIONS = {FORMAT_JSON: ".json", FORMAT_NDJSON: ".ndjson", FORMAT_SQLITE: ".db", FORMAT_PARQUET: ""}
+DB_NAME = "wpndatabase.db"
+SQLITE_HEADER = b"SQLite format 3\x00"
+BATCH_INDEX = "index.json"
+DELTA = "delta"
+HASH_CHUNK_SIZE = 1024 * 1024
+HANDLER_COLUMNS = ("RecordId", "PrimaryId", "ParentId", "WNSId", "HandlerType", "WNFEventName",
+                   "SystemDataPropertySet", "CreatedTime", "ModifiedTime")
+RECOVERED = "Recovered"
+WAL = "wal"
+METRICS_SUFFIX = ".metrics.json"
+PROTOCOL_VERSION = 1
+CHANGED_ROWS = "ChangedRowIds"
+FINGERPRINTS = "fingerprint_ranges"
+# Rowids summed up by one fingerprint in the incremental state
+FINGERPRINT_RANGE = 64
+# Fixed so the fingerprints do not change with the default protocol of a newer Python
+FINGERPRINT_PROTOCOL = 4
+DUPLICATES = "duplicates"
+FINGERPRINT_SIZE = 8
 
 def main(args):
     start_time = time.time()
+    if args.serve:
+        # The protocol owns stdout, anything printed goes to stderr
+        output = sys.stdout
+        sys.stdout = sys.stderr
+        serve(sys.stdin, output)
+        return
+    if args.batch:
+        if not args.output:
+            print("Output directory is required in batch mode.")
+            exit()
+        run_batch(args.batch, args.output, args.format, args.workers, args.decode_payloads, args.recover, args.wal,
+                  args.metrics, args.dedup, args.trace_memory)
+        total_time = round(time.time() - start_time, 2)
+        print('Elapsed time: ' + str(total_time) + 's')
+        return
     path = args.path
     jpath = args.json
     if not path:
@@ -25,93 +90,744 @@ def main(args):
     if not jpath:
         print("JSON result path is required.")
         exit()
-    data = process_db(path)
-    print(str(data))
-    with open(jpath, 'w') as fp:
-        json.dump(data, fp, indent=4)
+    if args.state and args.format not in (FORMAT_JSON, FORMAT_NDJSON):
+        print("Incremental extraction only writes JSON or NDJSON.")
+        exit()
+    if args.state and args.dedup:
+        print("Incremental extraction already leaves out the records seen before.")
+        exit()
+    if args.state and (args.recover or args.wal):
+        print("Incremental extraction only reads the live records, not the carved or WAL ones.")
+        exit()
+    metrics = Metrics(path, trace_memory=args.trace_memory) if args.metrics else NO_METRICS
+    dedup = DedupIndex(args.dedup) if args.dedup else None
+    if args.state:
+        run_incremental(path, jpath, args.format, args.state, args.decode_payloads, metrics)
+    elif args.format == FORMAT_NDJSON:
+        write_ndjson(path, jpath, args.decode_payloads, args.recover, args.wal, metrics, dedup)
+    elif args.format in (FORMAT_SQLITE, FORMAT_PARQUET):
+        write_export(path, jpath, args.format, args.decode_payloads, args.recover, args.wal, metrics, dedup)
+    else:
+        data = process_db(path, args.decode_payloads, args.recover, args.wal, metrics)
+        if data and dedup:
+            with metrics.phase("dedup"):
+                data[DUPLICATES] = dedup_assets(dedup, os.path.abspath(path), data[ASSETS])
+        with metrics.phase("print"):
+            print(str(data))
+        with metrics.phase("json_dump"):
+            with open(jpath, 'w') as fp:
+                json.dump(data, fp, indent=4, default=to_json)
+    if dedup:
+        dedup.close()
+        for kind, count in sorted(dedup.duplicates.items()):
+            metrics.count("duplicate_" + kind + "s", count)
+        print('Duplicates found: ' + ", ".join(kind + "s " + str(count) for kind, count in sorted(dedup.duplicates.items())))
+    metrics.save(jpath + METRICS_SUFFIX)
     total_time = round(time.time() - start_time, 2)
     print('Elapsed time: ' + str(total_time) + 's')
 
-def process_db(file):
+def connect_db(file):
+    # Read-only, so closing the connection neither checkpoints the WAL into the
+    # database nor deletes the -wal file, and the evidence stays as it was found
+    db_conn = sqlite3.connect("file:" + pathname2url(os.path.abspath(file)) + "?mode=ro", uri=True)
+    db_conn.row_factory = sqlite3.Row
+    return db_conn
+
+def process_db(file, decode_payloads=False, recover=False, wal=False, metrics=NO_METRICS):
+    try:
+        return read_db(file, decode_payloads=decode_payloads, recover=recover, wal=wal, metrics=metrics)
+    except Exception as e:
+        print(str(e))
+        return None
+
+def read_db(file, since=None, decode_payloads=False, recover=False, workers=None, wal=False, metrics=NO_METRICS):
     db_info = {}
+    wal_history = None
+    if wal:
+        with metrics.phase("wal"):
+            wal_history = read_wal_history(file, decode_payloads)
+    db_conn = connect_db(file)
+    c = db_conn.cursor()
     try:
-        db_conn = sqlite3.connect(file)
-        db_conn.row_factory = sqlite3.Row
-        c = db_conn.cursor()
         c.execute(PRAGMA_USER_VERSION)
         db_info[USER_VERSION] = c.fetchone()[0]
-        c.execute(QUERY_ASSETS)
-        asset_data = [dict(row) for row in c.fetchall()]
-        db_info[ASSETS] = process_assets(asset_data)
+        with metrics.phase("query_handlers"):
+            handlers = c.execute(QUERY_HANDLERS).fetchall()
+        with metrics.phase("query_assets"):
+            assets = c.execute(QUERY_HANDLER_ASSETS).fetchall()
+        # Notification rows are fetched while they are processed
+        with metrics.phase("process_assets"):
+            db_info[ASSETS] = process_assets(handlers, assets, query_notifications(c, since), decode_payloads,
+                                             since is not None)
+        metrics.count("handlers", len(handlers))
+        metrics.count("assets", len(assets))
+        metrics.count("notifications", sum(len(handler["Notifications"]) for handler in db_info[ASSETS].values()))
+        if since:
+            # Keep only the handlers that changed or received new notifications
+            db_info[ASSETS] = dict((id, dict_asset) for id, dict_asset in db_info[ASSETS].items()
+                                   if dict_asset["Notifications"] or handler_changed(dict_asset, since))
+    finally:
+        c.close()
+        db_conn.close()
+    if recover:
+        with metrics.phase("recover"):
+            merge_recovered(file, db_info[ASSETS], decode_payloads, workers)
+        metrics.count("recovered", sum(1 for handler in db_info[ASSETS].values() for record in
+                                       [handler] + handler["Notifications"] if record.get(RECOVERED)))
+    if wal_history:
+        mark_live_versions(wal_history, db_info[ASSETS], live_notification_keys(db_info[ASSETS]))
+        db_info[WAL] = wal_history
+    return db_info
+
+def write_ndjson(file, jpath, decode_payloads=False, recover=False, wal=False, metrics=NO_METRICS, dedup=None):
+    try:
+        with metrics.phase("stream_ndjson"):
+            count = dump_ndjson(file, jpath, decode_payloads=decode_payloads, recover=recover, wal=wal, dedup=dedup)
+        metrics.count("records", count)
+        print('Records written: ' + str(count))
+    except Exception as e:
+        print(str(e))
+
+def dump_ndjson(file, jpath, since=None, decode_payloads=False, recover=False, workers=None, wal=False, dedup=None,
+                delta=None):
+    # An incremental run writes its delta record right after the database record
+    count = 0
+    with open(jpath, 'w') as fp:
+        for record in dedup_stream(file, since, decode_payloads, recover, workers, wal, dedup):
+            fp.write(json.dumps(record, default=to_json))
+            fp.write('\n')
+            count += 1
+            if delta is not None and record[RECORD_TYPE] == "database":
+                fp.write(json.dumps(delta_record(delta)))
+                fp.write('\n')
+    return count
+
+def write_export(file, jpath, result_format, decode_payloads=False, recover=False, wal=False, metrics=NO_METRICS,
+                 dedup=None):
+    try:
+        with metrics.phase("export_" + result_format):
+            counts = export_db(file, jpath, result_format, decode_payloads=decode_payloads, recover=recover, wal=wal,
+                               dedup=dedup)
+        for table, count in counts.items():
+            metrics.count(table, count)
+        print('Rows written: ' + ", ".join(table + " " + str(count) for table, count in sorted(counts.items())))
     except Exception as e:
-        db_info = None
         print(str(e))
+
+def export_db(file, jpath, result_format, since=None, decode_payloads=False, recover=False, workers=None, wal=False,
+              dedup=None):
+    # Normalized tables with indexed arrival times, handlers and app names
+    records = dedup_stream(file, since, decode_payloads, recover, workers, wal, dedup)
+    if result_format == FORMAT_PARQUET:
+        return export_parquet(records, jpath)
+    return export_sqlite(records, jpath)
+
+def dedup_stream(file, since=None, decode_payloads=False, recover=False, workers=None, wal=False, dedup=None):
+    # The records of stream_db without those already found in another database of the index
+    records = stream_db(file, since, decode_payloads, recover, workers, wal)
+    if dedup:
+        return dedup_records(dedup, os.path.abspath(file), records)
+    return records
+
+def stream_db(file, since=None, decode_payloads=False, recover=False, workers=None, wal=False):
+    # Yields the database info, then every handler with its assets, then every
+    # notification, so notifications are never held in memory. With watermarks
+    # only the changed handlers and the new notifications are yielded. Recovered
+    # records and the WAL version history come last
+    wal_history = read_wal_history(file, decode_payloads) if wal else None
+    db_conn = connect_db(file)
+    c = db_conn.cursor()
+    try:
+        c.execute(PRAGMA_USER_VERSION)
+        yield {RECORD_TYPE: "database", USER_VERSION: c.fetchone()[0]}
+        processed_assets = process_assets(c.execute(QUERY_HANDLERS).fetchall(),
+                                          c.execute(QUERY_HANDLER_ASSETS), [])
+        for dict_asset in processed_assets.values():
+            if since and not handler_changed(dict_asset, since):
+                continue
+            del dict_asset["Notifications"]
+            dict_asset[RECORD_TYPE] = "handler"
+            yield dict_asset
+        live_notifications = set()
+        for row in query_notifications(c, since):
+            if row["HandlerId"] not in processed_assets:
+                continue
+            notif = new_notification(row, decode_payloads)
+            if notif:
+                notif[RECORD_TYPE] = "notification"
+                notif["HandlerId"] = row["HandlerId"]
+                if since is not None:
+                    notif["RowId"] = row["RowId"]
+                if recover or wal_history:
+                    live_notifications.add(notification_key(row["HandlerId"], notif))
+                yield notif
     finally:
         c.close()
         db_conn.close()
-    return db_info
+    if recover:
+        for record_type, key, record in recover_db(file, processed_assets, live_notifications,
+                                                   decode_payloads, workers):
+            record[RECORD_TYPE] = record_type
+            if record_type == "notification":
+                record["HandlerId"] = key
+            yield record
+    if wal_history:
+        mark_live_versions(wal_history, processed_assets, live_notifications)
+        for entry in wal_history["History"]:
+            entry[RECORD_TYPE] = "wal_history"
+            yield entry
 
-def process_assets(assets):
-    processed_assets = {}
-    for asset in assets:
-        id = asset["RecordId"]
-        if id in processed_assets:
-            # Not new asset
-            process_asset_key(asset, processed_assets[id])
-            process_notification(asset, dict_asset)
-        else:
-            # New asset
-            dict_asset = {}
-            dict_asset["HandlerId"] = id
-            dict_asset["HandlerPrimaryId"] = asset["PrimaryId"]
-            dict_asset["ParentId"] = asset["ParentId"]
-            dict_asset["WNSId"] = asset["WNSId"]
-            dict_asset["HandlerType"] = asset["HandlerType"]
-            dict_asset["WNFEventName"] = asset["WNFEventName"]
-            dict_asset["SystemDataPropertySet"] = asset["SystemDataPropertySet"]
-            dict_asset["CreatedTime"] = asset["CreatedTime"]
-            dict_asset["ModifiedTime"] = asset["ModifiedTime"]
-            dict_asset["OtherAssets"] = []
+def read_wal_history(file, decode_payloads=False):
+    # WAL versions in the same structure as the live handlers and notifications
+    wal = read_wal(file)
+    if not wal:
+        return None
+    for entry in wal["History"]:
+        for version in entry["Versions"]:
+            record = version["Record"]
+            if entry["Table"] == "Notification":
+                notif = new_notification(record, decode_payloads) or {}
+                notif["HandlerId"] = record.get("HandlerId")
+                version["Record"] = notif
+            else:
+                version["Record"] = carved_handler(record, entry["RowId"])
+    return wal
+
+def mark_live_versions(wal_history, processed_assets, live_notifications):
+    for entry in wal_history["History"]:
+        for version in entry["Versions"]:
+            record = version["Record"]
+            if entry["Table"] == "Notification":
+                version["Live"] = "Payload" in record and \
+                    notification_key(record["HandlerId"], record) in live_notifications
+            else:
+                live = processed_assets.get(entry["RowId"])
+                version["Live"] = bool(live) and live["HandlerPrimaryId"] == record["HandlerPrimaryId"] \
+                    and live["ModifiedTime"] == record["ModifiedTime"]
+
+def live_notification_keys(processed_assets):
+    live_notifications = set()
+    for id, dict_asset in processed_assets.items():
+        for notif in dict_asset["Notifications"]:
+            if not notif.get(RECOVERED):
+                live_notifications.add(notification_key(id, notif))
+    return live_notifications
+
+def merge_recovered(file, processed_assets, decode_payloads=False, workers=None):
+    live_notifications = live_notification_keys(processed_assets)
+    recovered = recover_db(file, processed_assets, live_notifications, decode_payloads, workers)
+    for record_type, key, record in list(recovered):
+        if record_type == "handler":
+            record["Notifications"] = []
+            processed_assets[key] = record
+            continue
+        if key not in processed_assets:
+            # Only the notification survived, keep its handler id
+            dict_asset = new_handler(dict((column, key if column == "RecordId" else None) for column in HANDLER_COLUMNS))
             dict_asset["Notifications"] = []
-            process_asset_key(asset, dict_asset)
-            process_notification(asset, dict_asset)
+            dict_asset[RECOVERED] = True
+            processed_assets[key] = dict_asset
+        processed_assets[key]["Notifications"].append(record)
+
+def recover_db(file, live_handlers, live_notifications, decode_payloads=False, workers=None):
+    # Yields ("handler", key, handler) and ("notification", HandlerId, notification)
+    # for the carved records that are not live
+    carved = carve_db(file, workers)
+    for record in carved["NotificationHandler"]:
+        dict_asset = carved_handler(record, record["RowId"])
+        live = live_handlers.get(dict_asset["HandlerId"])
+        if live and live["HandlerPrimaryId"] == dict_asset["HandlerPrimaryId"]:
+            continue
+        if dict_asset["HandlerId"] is None or live:
+            key = RECOVERED + "-" + str(record["Page"]) + "-" + str(record["Offset"])
+        else:
+            key = dict_asset["HandlerId"]
+        dict_asset[RECOVERED] = True
+        live_handlers[key] = dict_asset
+        yield "handler", key, dict_asset
+    for record in carved["Notification"]:
+        notif = new_notification(record, decode_payloads)
+        if not notif:
+            continue
+        key = notification_key(record["HandlerId"], notif)
+        if key in live_notifications:
+            continue
+        live_notifications.add(key)
+        notif[RECOVERED] = True
+        yield "notification", record["HandlerId"], notif
 
-            processed_assets[id] = dict_asset
+def carved_handler(record, rowid):
+    asset = dict((column, record.get(column)) for column in HANDLER_COLUMNS)
+    asset["RecordId"] = rowid
+    for column, value in asset.items():
+        if isinstance(value, bytes):
+            asset[column] = str(value)
+    return new_handler(asset)
 
-    return processed_assets
+def notification_key(handler_id, notif):
+    return (handler_id, notif["ArrivalTime"], notif["Type"], notif["Payload"])
+
+def query_notifications(c, since):
+    # With since (even empty, for a first incremental run) the rows carry their RowId
+    if since is None:
+        return c.execute(QUERY_NOTIFICATIONS)
+    if CHANGED_ROWS in since:
+        # Rowid ranges new or updated in place since the previous run, from their fingerprints
+        return query_row_ranges(c, since[CHANGED_ROWS])
+    if since:
+        return c.execute(QUERY_NOTIFICATIONS_SINCE, (since["NotificationRowId"] or 0, since["ArrivalTime"] or 0))
+    return c.execute(QUERY_NOTIFICATION_ROWS)
 
-def process_asset_key(asset, dict_asset):
-    if "AssetKey" not in asset:
+def query_row_ranges(c, ranges):
+    for start, end in ranges:
+        for row in c.execute(QUERY_NOTIFICATION_RANGE, (start, end)):
+            yield row
+
+def handler_changed(dict_asset, since):
+    return dict_asset["HandlerId"] > (since["RecordId"] or 0) or \
+        (dict_asset["ModifiedTime"] or 0) > (since["ModifiedTime"] or 0)
+
+def run_incremental(path, jpath, result_format, state_path, decode_payloads=False, metrics=NO_METRICS):
+    state = load_state(state_path)
+    key = os.path.abspath(path)
+    with metrics.phase("identity"):
+        identity = db_identity(path)
+    previous = state.get(key)
+    if previous and previous["sha256"] == identity["sha256"]:
+        print("No changes since last run")
+        data = {USER_VERSION: previous[USER_VERSION], ASSETS: {}, DELTA: {"status": "unchanged"}}
+        write_delta(jpath, result_format, data)
+        return
+    try:
+        with metrics.phase("watermarks"):
+            watermarks = read_watermarks(path)
+            fingerprints = read_fingerprints(path)
+        since = previous["watermarks"] if previous else None
+        if since and any((watermarks[name] or 0) < (since[name] or 0) for name in watermarks):
+            # The database was replaced or rebuilt, so the old watermarks mean nothing
+            since = None
+        status = "delta" if since else "full"
+        delta = {"status": status, "since": since}
+        if since and FINGERPRINTS in previous:
+            changed, count, removed = compare_fingerprints(previous[FINGERPRINTS], fingerprints)
+            since = dict(since)
+            since[CHANGED_ROWS] = changed
+            # Every row of a changed range is written again, with its RowId
+            delta["changed"] = count
+            delta["removed"] = removed
+        # A full run still gives the notifications their row ids
+        since = since or {}
+        if result_format == FORMAT_NDJSON:
+            with metrics.phase("stream_ndjson"):
+                count = dump_ndjson(path, jpath, since, decode_payloads, delta=delta)
+            metrics.count("records", count)
+            print('Records written: ' + str(count))
+            with open(jpath) as fp:
+                user_version = json.loads(fp.readline())[USER_VERSION]
+        else:
+            data = read_db(path, since, decode_payloads, metrics=metrics)
+            data[DELTA] = delta
+            user_version = data[USER_VERSION]
+            with metrics.phase("json_dump"):
+                write_delta(jpath, result_format, data)
+    except Exception as e:
+        print(str(e))
         return
+    identity[USER_VERSION] = user_version
+    identity["watermarks"] = watermarks
+    identity[FINGERPRINTS] = fingerprints
+    state[key] = identity
+    save_state(state_path, state)
+    print("Extraction: " + status)
+
+def write_delta(jpath, result_format, data):
+    with open(jpath, 'w') as fp:
+        if result_format == FORMAT_NDJSON:
+            fp.write(json.dumps({RECORD_TYPE: "database", USER_VERSION: data[USER_VERSION]}))
+            fp.write('\n')
+            fp.write(json.dumps(delta_record(data[DELTA])))
+            fp.write('\n')
+        else:
+            json.dump(data, fp, indent=4, default=to_json)
+
+def delta_record(delta):
+    # The delta of an NDJSON result: status, changed count and removed row ids
+    record = {RECORD_TYPE: DELTA}
+    record.update(delta)
+    return record
+
+def read_watermarks(file):
+    db_conn = connect_db(file)
+    try:
+        return dict(db_conn.execute(QUERY_WATERMARKS).fetchone())
+    finally:
+        db_conn.close()
+
+def read_fingerprints(file):
+    # {range: "digest-rowid bitmap"} of the notifications per FINGERPRINT_RANGE rowids,
+    # so the next run also finds the rows updated in place while the state stays small
+    db_conn = connect_db(file)
+    db_conn.row_factory = None
+    fingerprints = {}
+    try:
+        current = None
+        rows = []
+        bitmap = 0
+        for row in db_conn.execute(QUERY_FINGERPRINT_ROWS):
+            index, bit = divmod(row[0], FINGERPRINT_RANGE)
+            if index != current:
+                if rows:
+                    fingerprints[str(current)] = range_fingerprint(rows, bitmap)
+                current = index
+                rows = []
+                bitmap = 0
+            rows.append(row)
+            bitmap |= 1 << bit
+        if rows:
+            fingerprints[str(current)] = range_fingerprint(rows, bitmap)
+    finally:
+        db_conn.close()
+    return fingerprints
+
+def range_fingerprint(rows, bitmap):
+    # One digest of the whole range is much cheaper than one per row
+    digest = hashlib.sha256(pickle.dumps(rows, FINGERPRINT_PROTOCOL)).hexdigest()[:FINGERPRINT_SIZE * 2]
+    return digest + "-" + format(bitmap, "x")
+
+def compare_fingerprints(old, new):
+    # The [start, end) rowid ranges to read again, their row count and the rowids no longer present
+    changed = []
+    count = 0
+    removed = []
+    for index in sorted(int(index) for index in set(old) | set(new)):
+        old_fingerprint = old.get(str(index))
+        new_fingerprint = new.get(str(index))
+        if old_fingerprint == new_fingerprint:
+            continue
+        start = index * FINGERPRINT_RANGE
+        old_rows = fingerprint_bitmap(old_fingerprint)
+        new_rows = fingerprint_bitmap(new_fingerprint)
+        if new_fingerprint:
+            if changed and changed[-1][1] == start:
+                changed[-1][1] = start + FINGERPRINT_RANGE
+            else:
+                changed.append([start, start + FINGERPRINT_RANGE])
+            count += bin(new_rows).count("1")
+        removed.extend(start + bit for bit in range(FINGERPRINT_RANGE) if old_rows >> bit & 1 and not new_rows >> bit & 1)
+    return changed, count, removed
+
+def fingerprint_bitmap(fingerprint):
+    return int(fingerprint.split("-")[1], 16) if fingerprint else 0
+
+def db_identity(file):
+    stat = os.stat(file)
+    sha256 = hashlib.sha256()
+    # Uncheckpointed changes live in the WAL, so it is part of the identity
+    for part in (file, file + "-wal"):
+        if not os.path.exists(part):
+            continue
+        with open(part, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(HASH_CHUNK_SIZE), b""):
+                sha256.update(chunk)
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": sha256.hexdigest()}
+
+def load_state(state_path):
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path) as fp:
+        return json.load(fp)
+
+def save_state(state_path, state):
+    temp_path = state_path + ".tmp"
+    with open(temp_path, 'w') as fp:
+        json.dump(state, fp, separators=(",", ":"))
+    os.replace(temp_path, state_path)
+
+def run_batch(source, output_dir, result_format, workers, decode_payloads=False, recover=False, wal=False,
+              metrics=False, dedup=None, trace_memory=False):
+    files = find_databases(source)
+    print("Found " + str(len(files)) + " Notification databases")
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    extension = EXTENSIONS[result_format]
+    jobs = []
+    for file in files:
+        path_hash = hashlib.sha1(os.path.abspath(file).encode("utf-8")).hexdigest()[:16]
+        jobs.append((file, os.path.join(output_dir, "wpndatabase_" + path_hash + extension)))
+    options = (result_format, decode_payloads, recover, wal, metrics, dedup, trace_memory)
+    index = []
+    while jobs:
+        entries, jobs, error = run_batch_pool(jobs, workers, options)
+        index.extend(entries)
+        # A worker died (e.g. crashed inside SQLite) and the pool failed every file it had
+        # not finished. Files are handed out in order, so the one that crashed is among the
+        # first ones left: these run again one process each, the others in a new pool
+        suspects = jobs[:(workers or os.cpu_count() or 1) + 1]
+        jobs = jobs[len(suspects):]
+        for job in suspects:
+            entries, crashed, error = run_batch_pool([job], 1, options)
+            if crashed:
+                entries = [{"path": job[0], "result": None, "status": "error", "error": error}]
+                print("[error] " + job[0])
+            index.extend(entries)
+    index.sort(key=lambda entry: entry["path"])
+    with open(os.path.join(output_dir, BATCH_INDEX), 'w') as fp:
+        json.dump(index, fp, indent=4)
+    failed = len([entry for entry in index if entry["status"] != "ok"])
+    print("Processed " + str(len(index) - failed) + " databases, " + str(failed) + " failed")
+    return index
+
+def run_batch_pool(jobs, workers, options):
+    # Returns the index entries of the finished jobs, and the jobs left when the pool
+    # broke, in their original order, with the error of the pool
+    entries = []
+    broken = []
+    error = None
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for position, (file, result_path) in enumerate(jobs):
+            futures[executor.submit(process_batch_file, file, result_path, *options)] = position
+        for future in as_completed(futures):
+            file, result_path = jobs[futures[future]]
+            try:
+                entry = future.result()
+            except BrokenProcessPool as e:
+                broken.append(futures[future])
+                error = str(e)
+                continue
+            except Exception as e:
+                entry = {"path": file, "result": None, "status": "error", "error": str(e)}
+            print("[" + entry["status"] + "] " + file)
+            entries.append(entry)
+    return entries, [jobs[position] for position in sorted(broken)], error
+
+def process_batch_file(file, result_path, result_format, decode_payloads=False, recover=False, wal=False,
+                       metrics=False, dedup=None, trace_memory=False):
+    # dedup is the path of the index, each worker process opens its own connection
+    entry = {"path": file, "result": result_path, "status": "ok", "error": None}
+    start_time = time.time()
+    file_metrics = Metrics(file, trace_memory=trace_memory) if metrics else NO_METRICS
+    dedup_index = None
+    try:
+        if dedup:
+            dedup_index = DedupIndex(dedup)
+        if result_format == FORMAT_NDJSON:
+            # Databases are already spread over the pool, so each one is carved serially
+            with file_metrics.phase("stream_ndjson"):
+                entry["records"] = dump_ndjson(file, result_path, decode_payloads=decode_payloads,
+                                               recover=recover, workers=1, wal=wal, dedup=dedup_index)
+        elif result_format in (FORMAT_SQLITE, FORMAT_PARQUET):
+            with file_metrics.phase("export_" + result_format):
+                entry["rows"] = export_db(file, result_path, result_format, decode_payloads=decode_payloads,
+                                          recover=recover, workers=1, wal=wal, dedup=dedup_index)
+        else:
+            data = read_db(file, decode_payloads=decode_payloads, recover=recover, workers=1, wal=wal,
+                           metrics=file_metrics)
+            if dedup_index:
+                with file_metrics.phase("dedup"):
+                    data[DUPLICATES] = dedup_assets(dedup_index, os.path.abspath(file), data[ASSETS])
+            with file_metrics.phase("json_dump"):
+                with open(result_path, 'w') as fp:
+                    json.dump(data, fp, indent=4, default=to_json)
+            entry[USER_VERSION] = data[USER_VERSION]
+            entry["handlers"] = len(data[ASSETS])
+            entry["notifications"] = sum(len(handler["Notifications"]) for handler in data[ASSETS].values())
+    except Exception as e:
+        entry["status"] = "error"
+        entry["error"] = str(e)
+        entry["result"] = None
+        if os.path.isdir(result_path):
+            shutil.rmtree(result_path)
+        elif os.path.exists(result_path):
+            os.remove(result_path)
+    finally:
+        if dedup_index:
+            dedup_index.close()
+            entry["duplicates"] = dedup_index.duplicates
+    entry["elapsed"] = round(time.time() - start_time, 2)
+    if metrics:
+        entry["metrics"] = result_path + METRICS_SUFFIX
+        file_metrics.save(entry["metrics"])
+    return entry
+
+def serve(input, output):
+    # Worker mode: one JSON request per line on input, one JSON response per line
+    # on output, so a caller parses any number of databases with one interpreter.
+    # Requests are {"id", "command": "parse" (default), "ping" or "shutdown", "path",
+    # "result", "format", "decode_payloads", "recover", "wal", "metrics", "trace_memory", "profile", "dedup"}.
+    # Without a result path the records are streamed back as {"id", "record"} lines
+    write_message(output, {"status": "ready", "pid": os.getpid(), "protocol": PROTOCOL_VERSION})
+    for line in iter(input.readline, ""):
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            write_message(output, {"id": None, "status": "error", "error": "Invalid request: " + str(e)})
+            continue
+        command = request.get("command", "parse")
+        if command == "ping":
+            write_message(output, {"id": request.get("id"), "status": "ok", "pid": os.getpid()})
+        elif command == "shutdown":
+            write_message(output, {"id": request.get("id"), "status": "ok"})
+            return
+        elif command == "parse":
+            if request.get("profile"):
+                profiler = cProfile.Profile()
+                try:
+                    response = profiler.runcall(serve_parse, request, output)
+                finally:
+                    profiler.dump_stats(request["profile"])
+            else:
+                response = serve_parse(request, output)
+            write_message(output, response)
+        else:
+            write_message(output, {"id": request.get("id"), "status": "error", "error": "Unknown command: " + str(command)})
+
+def serve_parse(request, output):
+    file = request.get("path")
+    if not file or not os.path.exists(file):
+        return {"id": request.get("id"), "path": file, "status": "error", "error": "Database not found"}
+    decode_payloads = request.get("decode_payloads", False)
+    recover = request.get("recover", False)
+    wal = request.get("wal", False)
+    if request.get("result"):
+        entry = process_batch_file(file, request["result"], request.get("format", FORMAT_JSON), decode_payloads,
+                                   recover, wal, request.get("metrics", False), request.get("dedup"),
+                                   request.get("trace_memory", False))
+    else:
+        entry = {"path": file, "result": None, "status": "ok", "error": None, "records": 0}
+        start_time = time.time()
+        try:
+            for record in stream_db(file, decode_payloads=decode_payloads, recover=recover, workers=1, wal=wal):
+                write_message(output, {"id": request.get("id"), "record": record})
+                entry["records"] += 1
+        except Exception as e:
+            entry["status"] = "error"
+            entry["error"] = str(e)
+        entry["elapsed"] = round(time.time() - start_time, 2)
+    entry["id"] = request.get("id")
+    return entry
+
+def write_message(output, message):
+    output.write(json.dumps(message, default=to_json))
+    output.write('\n')
+    output.flush()
+
+def find_databases(source):
+    # A directory is searched recursively, a wpndatabase.db or SQLite file is taken
+    # as is (a corrupt one is then reported by its run), any other file is a manifest
+    # with one path per line relative to its own directory, and anything else is a glob
+    if os.path.isdir(source):
+        files = []
+        for root, dirs, names in os.walk(source):
+            files.extend(os.path.join(root, name) for name in names if name.lower() == DB_NAME)
+        return sorted(files)
+    if os.path.isfile(source):
+        if os.path.basename(source).lower() == DB_NAME:
+            return [source]
+        with open(source, 'rb') as fp:
+            if fp.read(len(SQLITE_HEADER)) == SQLITE_HEADER:
+                return [source]
+        base = os.path.dirname(os.path.abspath(source))
+        with open(source) as fp:
+            return [os.path.normpath(os.path.join(base, line.strip())) for line in fp if line.strip() and not line.startswith("#")]
+    return sorted(glob.glob(source, recursive=True))
+
+def process_assets(handlers, assets, notifications, decode_payloads=False, row_ids=False):
+    # Each table is read once and merged by HandlerId
+    processed_assets = {}
+    for handler in handlers:
+        dict_asset = new_handler(handler)
+        dict_asset["Notifications"] = []
+        processed_assets[dict_asset["HandlerId"]] = dict_asset
+    seen_assets = set()
+    for asset in assets:
+        dict_asset = processed_assets.get(asset["HandlerId"])
+        if dict_asset:
+            process_asset_key(asset, dict_asset, seen_assets)
+    for notification in notifications:
+        dict_asset = processed_assets.get(notification["HandlerId"])
+        if dict_asset:
+            process_notification(notification, dict_asset, decode_payloads, row_ids)
+    return processed_assets
+
+def new_handler(asset):
+    # Filled straight from the cursor row (or carved record), no dict per row
+    system_data = asset["SystemDataPropertySet"]
+    return HandlerRecord(asset["RecordId"], asset["PrimaryId"], asset["ParentId"], asset["WNSId"], asset["HandlerType"],
+                         asset["WNFEventName"], str(system_data) if isinstance(system_data, bytes) else system_data,
+                         asset["CreatedTime"], asset["ModifiedTime"])
+
+def process_asset_key(asset, dict_asset, seen_assets):
     asset_key = asset["AssetKey"]
     if asset_key == "DisplayName":
         dict_asset["AppName"] = asset["AssetValue"]
     elif asset_key:
-        asset_pair = {asset_key: asset["AssetValue"]}
-        if asset_pair not in dict_asset["OtherAssets"]:
-            dict_asset["OtherAssets"].append(asset_pair)
-        
-def process_notification(asset, dict_asset):
-    if "Payload" not in asset:
-        return
-    payload = asset["Payload"]
-    if payload:
-        # payload = xmltodict.parse(payload)
-        notif = {
-            "Payload": str(payload),
-            "Type": asset["Type"],
-            "ExpiryTime": asset["ExpiryTime"],
-            "ArrivalTime": asset["ArrivalTime"],
-            "PayloadType": asset["PayloadType"]
-            }
+        asset_id = (dict_asset["HandlerId"], asset_key, asset["AssetValue"])
+        if asset_id not in seen_assets:
+            seen_assets.add(asset_id)
+            dict_asset["OtherAssets"].append({asset_key: asset["AssetValue"]})
+
+def process_notification(asset, dict_asset, decode_payloads=False, row_ids=False):
+    notif = new_notification(asset, decode_payloads)
+    if notif:
+        if row_ids:
+            # Incremental results are matched to the earlier ones by row id
+            notif["RowId"] = asset["RowId"]
         dict_asset["Notifications"].append(notif)
 
+def new_notification(asset, decode_payloads=False):
+    payload = asset["Payload"]
+    if not payload:
+        return None
+    # The payload bytes are only turned into text when the record is serialized
+    notif = NotificationRecord(payload, asset["Type"], asset["ExpiryTime"], asset["ArrivalTime"], asset["PayloadType"])
+    if decode_payloads:
+        notif["DecodedPayload"] = decode_payload(payload)
+    return notif
+
 def setup_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', '--path', type=str, help='Path to Notifications DB (wpndatabase.db)')
-    parser.add_argument('-j', '--json', type=str, help='Path to result file in JSON')
+    parser.add_argument('-j', '--json', type=str, help='Path to result file (a directory for parquet)')
+    parser.add_argument('-f', '--format', type=str, choices=[FORMAT_JSON, FORMAT_NDJSON, FORMAT_SQLITE, FORMAT_PARQUET],
+                        default=FORMAT_JSON,
+                        help='Result format: a single JSON document, one JSON record per line (streamed), '
+                             'or indexed tables in a SQLite database or Parquet files')
+    parser.add_argument('-b', '--batch', type=str,
+                        help='Directory, glob or manifest file of Notifications DBs to process in parallel')
+    parser.add_argument('-o', '--output', type=str, help='Directory for the batch results and their index')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='Number of batch worker processes')
+    parser.add_argument('-s', '--state', type=str,
+                        help='Path to the incremental state file; only new or changed rows are extracted')
+    parser.add_argument('-d', '--decode-payloads', action='store_true',
+                        help='Add the text, launch arguments, images, tile bindings and badge decoded from each payload')
+    parser.add_argument('-r', '--recover', action='store_true',
+                        help='Carve deleted handlers and notifications from freelist pages and unallocated space')
+    parser.add_argument('-W', '--wal', action='store_true',
+                        help='Add the version history of every row found in the frames of wpndatabase.db-wal')
+    parser.add_argument('-m', '--metrics', action='store_true',
+                        help='Write the time, peak memory and row counts of each phase next to each result '
+                             '(<result>' + METRICS_SUFFIX + ')')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='With --metrics, also trace the peak Python memory of each phase (tracemalloc, slower)')
+    parser.add_argument('--dedup', type=str, default=None,
+                        help='Path to the deduplication index shared by the databases of a case (SQLite); handlers '
+                             'and notifications already found in another database are left out')
+    parser.add_argument('--serve', action='store_true',
+                        help='Worker mode: parse the databases requested as JSON lines on stdin, answer on stdout')
+    parser.add_argument('--profile', type=str, default=None,
+                        help='Path to cProfile statistics of the run (the main process only in batch mode)')
     return parser.parse_args()
 
 if __name__ == "__main__":
     args = setup_args()
-    main(args)
\ No newline at end of file
+    if args.profile:
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(main, args)
+        finally:
+            profiler.dump_stats(args.profile)
+    else:
+        main(args)
\ No newline at end of file
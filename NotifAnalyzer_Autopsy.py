@@ -1,10 +1,22 @@
 import jarray
 import json
-import inspect
 import subprocess
 import os
+import sys
+import threading
+import time
+from Queue import Queue, Empty
 from java.io import File
+from java.lang import Class
 from java.lang import System
+from java.lang import Runtime
+from java.lang import Exception as JavaException
+from java.sql import DriverManager
+from java.util import ArrayList
+from java.util.concurrent import Callable
+from java.util.concurrent import ExecutorCompletionService
+from java.util.concurrent import Executors
+from java.util.concurrent import TimeUnit
 from java.util.logging import Level
 from javax.swing import BoxLayout
 from javax.swing import JButton
@@ -35,6 +47,33 @@ from org.sleuthkit.autopsy.casemodule.services import Services
 from org.sleuthkit.autopsy.casemodule.services import FileManager
 from org.sleuthkit.autopsy.casemodule.services import Blackboard
 from org.sleuthkit.autopsy.datamodel import ContentUtils
+from NotifPayload import decode_payload
+from NotifTimeline import decode_notification_times
+from NotifMetrics import Metrics, load_metrics
+from NotifDedup import DedupIndex, dedup_assets, FIRST_SOURCE
+from NotifRecords import blob_text
+
+# Same queries as NotifAnalyzer.py, used when the database is read in-process through JDBC
+QUERY_HANDLERS = 'SELECT RecordId, PrimaryId, ParentId, WNSId, HandlerType, WNFEventName, SystemDataPropertySet, \
+                    CreatedTime, ModifiedTime \
+                FROM NotificationHandler \
+                ORDER BY RecordId'
+QUERY_HANDLER_ASSETS = 'SELECT HandlerId, AssetKey, AssetValue FROM HandlerAssets'
+QUERY_NOTIFICATIONS = 'SELECT HandlerId, Payload, Type, ArrivalTime, PayloadType, ExpiryTime FROM Notification'
+# Number of artifacts posted to the blackboard at once
+ARTIFACT_BATCH_SIZE = 1000
+# Upper bound of databases extracted and parsed at the same time
+MAX_WORKERS = 4
+METRICS_FILE = "metrics.json"
+JOB_METRICS_FILE = "na-metrics.json"
+PARSER_METRICS_SUFFIX = ".metrics.json"
+# Content hashes of the handlers and notifications already posted in the case
+DEDUP_DIR = "NotificationsAnalyzer"
+DEDUP_INDEX = "dedup.db"
+PARSER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "NotifAnalyzer.py")
+# Seconds a parser worker has to start or to answer a health check before it is killed
+WORKER_START_TIMEOUT = 60
+WORKER_PING_TIMEOUT = 10
 
 class NotificationAnalyzerDataSourceIngestModuleFactory(IngestModuleFactoryAdapter):
 
@@ -73,7 +112,9 @@ class NotificationAnalyzerDataSourceIngestModule(DataSourceIngestModule):
     _logger = Logger.getLogger(NotificationAnalyzerDataSourceIngestModuleFactory.moduleName)
 
     def log(self, level, msg):
-        self._logger.logp(level, self.__class__.__name__, inspect.stack()[1][3], msg)
+        # The caller is only looked up for messages that are actually logged
+        if self._logger.isLoggable(level):
+            self._logger.logp(level, self.__class__.__name__, sys._getframe(1).f_code.co_name, msg)
 
     def __init__(self, settings):
         self.context = None
@@ -87,11 +128,23 @@ class NotificationAnalyzerDataSourceIngestModule(DataSourceIngestModule):
 
         self.temp_dir = Case.getCurrentCase().getTempDirectory()
         blackboard = Case.getCurrentCase().getServices().getBlackboard()
+        try:
+            self.tsk_blackboard = Case.getCurrentCase().getSleuthkitCase().getBlackboard()
+        except AttributeError:
+            # Older Autopsy versions without the TSK blackboard, see post_artifacts
+            self.tsk_blackboard = None
+        self.pending_artifacts = []
+        self.progress_bar = None
+        self.use_metrics = self.local_settings.getSetting("metrics") == "true"
+        self.job_metrics = Metrics("ingest", self.use_metrics)
+        self.current_metrics = self.job_metrics
         
-        self.use_undark = self.local_settings.getSetting("undark") == "true"
-        self.use_mdg = self.local_settings.getSetting("mdg") == "true"
-        self.use_crawler = self.local_settings.getSetting("crawler") == "true"
-        self.use_b2l = self.local_settings.getSetting("b2l") == "true"
+        self.use_recover = self.local_settings.getSetting("recover") == "true"
+        self.use_wal = self.local_settings.getSetting("wal") == "true"
+        self.use_in_process = self.local_settings.getSetting("in_process") == "true"
+        self.use_decode = self.local_settings.getSetting("decode_payloads") == "true"
+        self.use_dedup = self.local_settings.getSetting("dedup") == "true"
+        self.dedup_index = None
         self.python_path = self.local_settings.getSetting("python_path")
         self.log(Level.INFO, "Python path: " + str(self.python_path))
         
@@ -114,10 +167,27 @@ class NotificationAnalyzerDataSourceIngestModule(DataSourceIngestModule):
         # Notification attributes
         self.att_payload = self.create_attribute_type('NA_PAYLOAD', BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Payload", blackboard)
         self.att_payload_type = self.create_attribute_type('NA_PAYLOAD_TYPE', BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Content format", blackboard)
+
+        # Decoded payload attributes
+        self.att_payload_text = self.create_attribute_type('NA_PAYLOAD_TEXT', BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Text", blackboard)
+        self.att_payload_launch = self.create_attribute_type('NA_PAYLOAD_LAUNCH', BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Launch arguments", blackboard)
+        self.att_payload_images = self.create_attribute_type('NA_PAYLOAD_IMAGES', BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Images", blackboard)
+        self.att_payload_tiles = self.create_attribute_type('NA_PAYLOAD_TILE_BINDINGS', BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Tile bindings", blackboard)
+        self.att_payload_badge = self.create_attribute_type('NA_PAYLOAD_BADGE', BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Badge", blackboard)
         
         # DB User Version
         self.att_db_uv = self.create_attribute_type('NA_DB_UV', BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "SQLite User Version", blackboard)
 
+        # Records carved from deleted space
+        self.att_recovered = self.create_attribute_type('NA_RECOVERED', BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "Recovered (deleted)", blackboard)
+
+        # Handlers already found in another database of the case
+        self.att_first_source = self.create_attribute_type('NA_FIRST_SOURCE', BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "First found in", blackboard)
+
+        # Row versions read from the WAL frames
+        self.att_wal_state = self.create_attribute_type('NA_WAL_STATE', BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "WAL version state", blackboard)
+        self.att_wal_frame = self.create_attribute_type('NA_WAL_FRAME', BlackboardAttribute.TSK_BLACKBOARD_ATTRIBUTE_VALUE_TYPE.STRING, "WAL frames", blackboard)
+
     # Where the analysis is done.
     # The 'dataSource' object being passed in is of type org.sleuthkit.datamodel.Content.
     # See: http://www.sleuthkit.org/sleuthkit/docs/jni-docs/latest/interfaceorg_1_1sleuthkit_1_1datamodel_1_1_content.html
@@ -132,73 +202,60 @@ class NotificationAnalyzerDataSourceIngestModule(DataSourceIngestModule):
         moduleName = NotificationAnalyzerDataSourceIngestModuleFactory.moduleName
 
         fileManager = Case.getCurrentCase().getServices().getFileManager()
-        files = fileManager.findFiles(dataSource, "wpndatabase.db") 
+        with self.job_metrics.phase("find_files"):
+            files = fileManager.findFiles(dataSource, "wpndatabase.db")
+        self.job_metrics.count("databases", len(files))
 
         num_files = len(files)
         self.log(Level.INFO, "Found " + str(num_files) + " Notification databases")
         progressBar.switchToDeterminate(num_files)
-        for file in files:
-            full_path = (file.getParentPath() + file.getName())
-            split = full_path.split('/')
-            try:
-                username = split[-11]
-                guid = split[-4]
-            except IndexError:
-                username = "UNKNOWN"
-                guid = "UNKNOWN"
-            self.art_notification = self.create_artifact_type("NA_NOTIFICATION_" + guid + "_" + username,"User " + username + " - Notifications", blackboard)
-            self.art_notification_handler = self.create_artifact_type("NA_NOTIFICATION_HANDLER_" + guid + "_" + username,"User " + username + " - Notification handler", blackboard)
-            self.art_settings = self.create_artifact_type("NA_SETTINGS_" + guid + "_" + username,"User " + username + " - Database settings", blackboard)
-
-            temp_file = os.path.join(self.temp_dir, file.getName())
-            ContentUtils.writeToFile(file, File(temp_file))
-
-            path_to_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "NotifAnalyzer.py")
-            result_file = os.path.join(self.temp_dir, "result.json")
-            self.log(Level.INFO, "Saving notification output to " + str(result_file))
-            with open(os.path.join(self.temp_dir, 'na-debug.log'), 'w') as f:
-                subprocess.Popen([self.python_path, path_to_script, '-p', temp_file, '-j', result_file],stdout=f).communicate()
-            with open(result_file) as json_file:
-                data = json.load(json_file)
-                
-                art = file.newArtifact(self.art_settings.getTypeID())
-                user_version = data["user_version"]
-                art.addAttribute(BlackboardAttribute(self.att_db_uv, moduleName, str(user_version)))
-                self.index_artifact(blackboard, art, self.art_settings)
-                
-                for key, handler in data["assets"].iteritems():
-                    for child_key, value in handler.iteritems():
-                        if not value and child_key <> "Notifications":
-                            handler[child_key] = "N/A"
-                    if "AppName" in handler:
-                        app_name = handler["AppName"]
-                    else:
-                        app_name = "N/A"
-                    art = file.newArtifact(self.art_notification_handler.getTypeID())
-                    art.addAttribute(BlackboardAttribute(self.att_id, moduleName, str(handler["HandlerId"])))
-                    art.addAttribute(BlackboardAttribute(self.att_handler_primary_id, moduleName, str(handler["HandlerPrimaryId"])))
-                    art.addAttribute(BlackboardAttribute(self.att_parent_id, moduleName, str(handler["ParentId"])))
-                    art.addAttribute(BlackboardAttribute(self.att_app_name, moduleName, app_name))
-                    art.addAttribute(BlackboardAttribute(self.att_created_time, moduleName, str(handler["CreatedTime"])))
-                    art.addAttribute(BlackboardAttribute(self.att_modified_time, moduleName, str(handler["ModifiedTime"])))
-                    art.addAttribute(BlackboardAttribute(self.att_wnf_event_name, moduleName, str(handler["WNFEventName"])))
-                    art.addAttribute(BlackboardAttribute(self.att_type, moduleName, str(handler["HandlerType"])))
-                    art.addAttribute(BlackboardAttribute(self.att_wns_id, moduleName, str(handler["WNSId"])))
-                    art.addAttribute(BlackboardAttribute(self.att_system_data_property_set, moduleName, str(handler["SystemDataPropertySet"])))
-                    self.index_artifact(blackboard, art, self.art_notification_handler)
-
-                    for notification in handler["Notifications"]:
-                        art = file.newArtifact(self.art_notification.getTypeID())
-                        art.addAttribute(BlackboardAttribute(self.att_type, moduleName, str(notification["Type"])))
-                        art.addAttribute(BlackboardAttribute(self.att_payload_type, moduleName, str(notification["PayloadType"])))
-                        art.addAttribute(BlackboardAttribute(self.att_payload, moduleName, str(notification["Payload"])))
-                        expiry_time = self.windows_filetime_to_epoch(notification["ExpiryTime"])
-                        art.addAttribute(BlackboardAttribute(self.att_expiry_time, moduleName, expiry_time))
-                        arrival_time = self.windows_filetime_to_epoch(notification["ArrivalTime"])
-                        art.addAttribute(BlackboardAttribute(self.att_arrival_time, moduleName, arrival_time))
-
-                        self.index_artifact(blackboard, art, self.art_notification)
-            self.log(Level.INFO, "Processed successfully...")
+        self.progress_bar = progressBar
+
+        # Databases are copied and parsed by a pool of workers, each in its own
+        # temp directory, while artifacts are only created on this thread
+        num_workers = max(1, min(MAX_WORKERS, Runtime.getRuntime().availableProcessors(), num_files))
+        if self.use_dedup:
+            dedup_dir = os.path.join(Case.getCurrentCase().getModuleDirectory(), DEDUP_DIR)
+            if not os.path.isdir(dedup_dir):
+                os.makedirs(dedup_dir)
+            self.dedup_index = DedupIndex(os.path.join(dedup_dir, DEDUP_INDEX))
+        # The Python parsers are started on first use and reused for the next databases
+        self.worker_pool = AnalyzerWorkerPool(self.python_path, self.temp_dir)
+        executor = Executors.newFixedThreadPool(num_workers)
+        completion = ExecutorCompletionService(executor)
+        for file_index, file in enumerate(files):
+            work_dir = os.path.join(self.temp_dir, "na-" + str(file_index))
+            metrics = Metrics(file.getParentPath() + file.getName(), self.use_metrics)
+            completion.submit(NotificationDatabaseTask(self, file, work_dir, metrics))
+        completed = 0
+        try:
+            while completed < num_files:
+                if self.context.dataSourceIngestIsCancelled():
+                    self.log(Level.INFO, "Ingest cancelled")
+                    return IngestModule.ProcessResult.OK
+                future = completion.poll(500, TimeUnit.MILLISECONDS)
+                if future is None:
+                    continue
+                completed += 1
+                file, work_dir, data, metrics = future.get()
+                progressBar.progress(file.getName(), completed)
+                if data is not None:
+                    self.current_metrics = metrics
+                    with metrics.phase("add_artifacts"):
+                        self.set_artifact_types(file, blackboard)
+                        self.add_artifacts(file, blackboard, data)
+                    self.flush_artifacts(blackboard)
+                    self.current_metrics = self.job_metrics
+                    self.log(Level.INFO, "Processed successfully...")
+                self.save_metrics(metrics, work_dir)
+        finally:
+            executor.shutdownNow()
+            # Workers still parsing are only left when cancelled, killing them unblocks their threads
+            self.worker_pool.stop(kill=self.context.dataSourceIngestIsCancelled())
+            if self.dedup_index:
+                self.dedup_index.close()
+                self.dedup_index = None
+            self.save_metrics(self.job_metrics, self.temp_dir, JOB_METRICS_FILE)
 
         #Post a message to the ingest messages in box.
         message = IngestMessage.createMessage(IngestMessage.MessageType.DATA,
@@ -207,19 +264,343 @@ class NotificationAnalyzerDataSourceIngestModule(DataSourceIngestModule):
 
         return IngestModule.ProcessResult.OK
 
-    def windows_filetime_to_epoch(self, windows_filetime):
-        return windows_filetime / 10000000 - 11644473600
+    def set_artifact_types(self, file, blackboard):
+        full_path = (file.getParentPath() + file.getName())
+        split = full_path.split('/')
+        try:
+            username = split[-11]
+            guid = split[-4]
+        except IndexError:
+            username = "UNKNOWN"
+            guid = "UNKNOWN"
+        self.art_notification = self.create_artifact_type("NA_NOTIFICATION_" + guid + "_" + username,"User " + username + " - Notifications", blackboard)
+        self.art_notification_handler = self.create_artifact_type("NA_NOTIFICATION_HANDLER_" + guid + "_" + username,"User " + username + " - Notification handler", blackboard)
+        self.art_settings = self.create_artifact_type("NA_SETTINGS_" + guid + "_" + username,"User " + username + " - Database settings", blackboard)
+
+    def save_metrics(self, metrics, work_dir, name=METRICS_FILE):
+        if not metrics.enabled:
+            return
+        if metrics is not self.job_metrics:
+            self.job_metrics.add_child(metrics)
+        try:
+            metrics.save(os.path.join(work_dir, name))
+        except (Exception, JavaException) as e:
+            self.log(Level.WARNING, "Error writing metrics: " + str(e))
+
+    # Runs on a worker thread: copies the database to its own directory and parses it
+    def parse_file(self, file, work_dir, metrics):
+        if self.context.dataSourceIngestIsCancelled():
+            return None
+        if not os.path.isdir(work_dir):
+            os.makedirs(work_dir)
+        temp_file = os.path.join(work_dir, file.getName())
+        with metrics.phase("copy"):
+            ContentUtils.writeToFile(file, File(temp_file))
+            if self.use_wal:
+                self.copy_wal(file, temp_file)
+        metrics.count("bytes", file.getSize())
+        if self.context.dataSourceIngestIsCancelled():
+            return None
+        # Carving and the WAL history need the external parser, JDBC only sees the live records
+        if self.use_in_process and not self.use_recover and not self.use_wal:
+            try:
+                with metrics.phase("parse_jdbc"):
+                    return self.parse_jdbc(temp_file)
+            except (Exception, JavaException) as e:
+                self.log(Level.WARNING, "In-process parsing failed, falling back to Python: " + str(e))
+        return self.parse_python(temp_file, work_dir, metrics)
+
+    # The -wal file is only read by NotifAnalyzer.py, next to its copy of the database
+    def copy_wal(self, file, temp_file):
+        fileManager = Case.getCurrentCase().getServices().getFileManager()
+        for wal_file in fileManager.findFiles(file.getDataSource(), file.getName() + "-wal", file.getParentPath()):
+            if wal_file.getParentPath() == file.getParentPath() and wal_file.getSize() > 0:
+                ContentUtils.writeToFile(wal_file, File(temp_file + "-wal"))
+                return
+
+    def add_artifacts(self, file, blackboard, data):
+        self.add_settings_artifact(file, blackboard, data["user_version"])
+        if self.dedup_index:
+            # Records found in another database of the case (another user, snapshot
+            # or acquisition) are not posted again, the index lists their sources
+            with self.current_metrics.phase("dedup"):
+                links = dedup_assets(self.dedup_index, file.getUniquePath(), data["assets"])
+            self.current_metrics.count("duplicates", len(links))
+            self.log(Level.INFO, str(len(links)) + " records already found in the case were not posted again")
+        decode_notification_times([notification for handler in data["assets"].itervalues()
+                                   for notification in handler["Notifications"]])
+        for key, handler in data["assets"].iteritems():
+            if self.context.dataSourceIngestIsCancelled():
+                return
+            self.add_handler_artifact(file, blackboard, handler)
+            for notification in handler["Notifications"]:
+                self.add_notification_artifact(file, blackboard, notification)
+        if data.get("wal"):
+            self.add_wal_artifacts(file, blackboard, data["wal"])
+
+    # Live versions are already posted, only the older and deleted ones are added
+    def add_wal_artifacts(self, file, blackboard, wal):
+        for entry in wal["History"]:
+            if self.context.dataSourceIngestIsCancelled():
+                return
+            for version in entry["Versions"]:
+                if version.get("Live"):
+                    continue
+                record = version["Record"]
+                record["WalState"] = version["State"]
+                record["WalFrames"] = str(version["Frame"]) + "-" + str(version["LastSeenFrame"])
+                if entry["Table"] == "Notification":
+                    if "Payload" in record:
+                        self.add_notification_artifact(file, blackboard, record)
+                else:
+                    self.add_handler_artifact(file, blackboard, record)
+
+    # Reads the database directly through the SQLite JDBC driver shipped with Autopsy
+    def parse_jdbc(self, temp_file):
+        Class.forName("org.sqlite.JDBC")
+        db_conn = DriverManager.getConnection("jdbc:sqlite:" + temp_file)
+        try:
+            data = {}
+            stmt = db_conn.createStatement()
+            rs = stmt.executeQuery("PRAGMA user_version")
+            rs.next()
+            data["user_version"] = rs.getInt(1)
+            rs.close()
+
+            handlers = {}
+            rs = stmt.executeQuery(QUERY_HANDLERS)
+            while rs.next():
+                handler = {}
+                handler["HandlerId"] = rs.getLong("RecordId")
+                handler["HandlerPrimaryId"] = rs.getObject("PrimaryId")
+                handler["ParentId"] = rs.getObject("ParentId")
+                handler["WNSId"] = rs.getObject("WNSId")
+                handler["HandlerType"] = rs.getObject("HandlerType")
+                handler["WNFEventName"] = rs.getObject("WNFEventName")
+                handler["SystemDataPropertySet"] = self.column_text(rs.getObject("SystemDataPropertySet"))
+                handler["CreatedTime"] = rs.getObject("CreatedTime")
+                handler["ModifiedTime"] = rs.getObject("ModifiedTime")
+                handler["OtherAssets"] = []
+                handler["Notifications"] = []
+                handlers[handler["HandlerId"]] = handler
+            rs.close()
+            data["assets"] = handlers
+
+            rs = stmt.executeQuery(QUERY_HANDLER_ASSETS)
+            seen_assets = set()
+            while rs.next():
+                handler = handlers.get(rs.getLong("HandlerId"))
+                if handler is None:
+                    continue
+                asset_key = rs.getString("AssetKey")
+                if asset_key == "DisplayName":
+                    handler["AppName"] = rs.getString("AssetValue")
+                elif asset_key:
+                    asset_id = (handler["HandlerId"], asset_key, rs.getString("AssetValue"))
+                    if asset_id not in seen_assets:
+                        seen_assets.add(asset_id)
+                        handler["OtherAssets"].append({asset_key: asset_id[2]})
+            rs.close()
+
+            rs = stmt.executeQuery(QUERY_NOTIFICATIONS)
+            while rs.next():
+                handler = handlers.get(rs.getLong("HandlerId"))
+                if handler is None:
+                    continue
+                payload = rs.getObject("Payload")
+                if not payload:
+                    continue
+                notification = {}
+                notification["Payload"] = self.column_text(payload)
+                notification["Type"] = rs.getObject("Type")
+                notification["PayloadType"] = rs.getObject("PayloadType")
+                notification["ExpiryTime"] = rs.getObject("ExpiryTime")
+                notification["ArrivalTime"] = rs.getObject("ArrivalTime")
+                if self.use_decode:
+                    notification["DecodedPayload"] = decode_payload(payload if isinstance(payload, basestring) else payload.tostring())
+                handler["Notifications"].append(notification)
+            rs.close()
+            stmt.close()
+            return data
+        finally:
+            db_conn.close()
+
+    # Runs NotifAnalyzer.py with the configured interpreter and loads its JSON result
+    def parse_python(self, temp_file, work_dir, metrics):
+        result_file = os.path.join(work_dir, "result.json")
+        self.log(Level.INFO, "Saving notification output to " + str(result_file))
+        request = {"id": temp_file, "path": temp_file, "result": result_file, "format": "json",
+                   "decode_payloads": self.use_decode, "recover": self.use_recover, "wal": self.use_wal,
+                   "metrics": self.use_metrics}
+        if self.use_metrics:
+            request["profile"] = os.path.join(work_dir, 'parser.prof')
+        start_time = time.time()
+        # A crashed worker is replaced and the database retried once
+        for attempt in range(2):
+            if self.context.dataSourceIngestIsCancelled():
+                return None
+            worker = self.acquire_worker(metrics)
+            try:
+                response = worker.request(request)
+            except (Exception, JavaException) as e:
+                self.worker_pool.discard(worker)
+                if attempt or self.context.dataSourceIngestIsCancelled():
+                    raise
+                self.log(Level.WARNING, "Parser worker failed on " + temp_file + ", restarting it: " + str(e))
+                metrics.count("worker_restarts")
+                continue
+            self.worker_pool.release(worker)
+            break
+        if response.get("status") != "ok":
+            raise IOError("Parser error: " + str(response.get("error")))
+        parse_time = time.time() - start_time
+        metrics.record("parse_python", parse_time)
+        if self.use_metrics:
+            # The rest of the request time is the JSON exchange with the worker
+            parser_metrics = load_metrics(result_file + PARSER_METRICS_SUFFIX)
+            if parser_metrics:
+                metrics.add_child(parser_metrics)
+                metrics.record("parser_overhead", max(0, parse_time - parser_metrics["Seconds"]))
+        with metrics.phase("json_load"):
+            with open(result_file) as json_file:
+                return json.load(json_file)
+
+    def acquire_worker(self, metrics):
+        worker = self.worker_pool.acquire()
+        if worker.started:
+            return worker
+        try:
+            with metrics.phase("worker_start"):
+                worker.start()
+        except (Exception, JavaException):
+            self.worker_pool.discard(worker)
+            raise
+        self.log(Level.INFO, "Started parser worker " + str(worker.pid))
+        return worker
+
+    # Same values as NotifAnalyzer.py: TEXT as it is, BLOBs (byte[]) as str(bytes) gives them on Python 3
+    def column_text(self, value):
+        if value is None or isinstance(value, basestring):
+            return value
+        return blob_text(value.tostring())
+
+    def add_settings_artifact(self, file, blackboard, user_version):
+        moduleName = NotificationAnalyzerDataSourceIngestModuleFactory.moduleName
+        attributes = ArrayList()
+        attributes.add(BlackboardAttribute(self.att_db_uv, moduleName, str(user_version)))
+        self.queue_artifact(blackboard, file, self.art_settings, attributes)
 
-    def index_artifact(self, blackboard, artifact, artifact_type):
+    def add_handler_artifact(self, file, blackboard, handler):
+        moduleName = NotificationAnalyzerDataSourceIngestModuleFactory.moduleName
+        for child_key, value in handler.iteritems():
+            if not value and child_key <> "Notifications":
+                handler[child_key] = "N/A"
+        if "AppName" in handler:
+            app_name = handler["AppName"]
+        else:
+            app_name = "N/A"
+        attributes = ArrayList()
+        attributes.add(BlackboardAttribute(self.att_id, moduleName, str(handler["HandlerId"])))
+        attributes.add(BlackboardAttribute(self.att_handler_primary_id, moduleName, str(handler["HandlerPrimaryId"])))
+        attributes.add(BlackboardAttribute(self.att_parent_id, moduleName, str(handler["ParentId"])))
+        attributes.add(BlackboardAttribute(self.att_app_name, moduleName, app_name))
+        attributes.add(BlackboardAttribute(self.att_created_time, moduleName, str(handler["CreatedTime"])))
+        attributes.add(BlackboardAttribute(self.att_modified_time, moduleName, str(handler["ModifiedTime"])))
+        attributes.add(BlackboardAttribute(self.att_wnf_event_name, moduleName, str(handler["WNFEventName"])))
+        attributes.add(BlackboardAttribute(self.att_type, moduleName, str(handler["HandlerType"])))
+        attributes.add(BlackboardAttribute(self.att_wns_id, moduleName, str(handler["WNSId"])))
+        attributes.add(BlackboardAttribute(self.att_system_data_property_set, moduleName, str(handler["SystemDataPropertySet"])))
+        if handler.get("Recovered"):
+            attributes.add(BlackboardAttribute(self.att_recovered, moduleName, "Yes"))
+        if handler.get(FIRST_SOURCE):
+            attributes.add(BlackboardAttribute(self.att_first_source, moduleName, handler[FIRST_SOURCE]))
+        self.add_wal_attributes(handler, attributes)
+        self.queue_artifact(blackboard, file, self.art_notification_handler, attributes)
+
+    def add_notification_artifact(self, file, blackboard, notification):
+        moduleName = NotificationAnalyzerDataSourceIngestModuleFactory.moduleName
+        attributes = ArrayList()
+        attributes.add(BlackboardAttribute(self.att_type, moduleName, str(notification["Type"])))
+        attributes.add(BlackboardAttribute(self.att_payload_type, moduleName, str(notification["PayloadType"])))
+        attributes.add(BlackboardAttribute(self.att_payload, moduleName, notification["Payload"]))
+        # Decoded in bulk beforehand, except for single records such as WAL versions
+        decode_notification_times([notification])
+        if notification["ExpiryEpoch"] is not None:
+            attributes.add(BlackboardAttribute(self.att_expiry_time, moduleName, long(notification["ExpiryEpoch"])))
+        if notification["ArrivalEpoch"] is not None:
+            attributes.add(BlackboardAttribute(self.att_arrival_time, moduleName, long(notification["ArrivalEpoch"])))
+        if notification.get("Recovered"):
+            attributes.add(BlackboardAttribute(self.att_recovered, moduleName, "Yes"))
+        self.add_wal_attributes(notification, attributes)
+        decoded = notification.get("DecodedPayload")
+        if decoded:
+            if decoded["Text"]:
+                attributes.add(BlackboardAttribute(self.att_payload_text, moduleName, "\n".join(decoded["Text"])))
+            launch = [decoded["Launch"]] if decoded["Launch"] else []
+            if launch or decoded["Arguments"]:
+                attributes.add(BlackboardAttribute(self.att_payload_launch, moduleName, "\n".join(launch + decoded["Arguments"])))
+            if decoded["Images"]:
+                attributes.add(BlackboardAttribute(self.att_payload_images, moduleName, "\n".join(decoded["Images"])))
+            if decoded["TileBindings"]:
+                attributes.add(BlackboardAttribute(self.att_payload_tiles, moduleName, ", ".join(str(t) for t in decoded["TileBindings"])))
+            if decoded["Badge"]:
+                attributes.add(BlackboardAttribute(self.att_payload_badge, moduleName, decoded["Badge"]))
+        self.queue_artifact(blackboard, file, self.art_notification, attributes)
+
+    def add_wal_attributes(self, record, attributes):
+        moduleName = NotificationAnalyzerDataSourceIngestModuleFactory.moduleName
+        if record.get("WalState"):
+            attributes.add(BlackboardAttribute(self.att_wal_state, moduleName, record["WalState"]))
+            attributes.add(BlackboardAttribute(self.att_wal_frame, moduleName, record["WalFrames"]))
+
+    def queue_artifact(self, blackboard, file, artifact_type, attributes):
+        art = file.newArtifact(artifact_type.getTypeID())
+        art.addAttributes(attributes)
+        self.current_metrics.count("artifacts")
+        self.pending_artifacts.append((artifact_type, art))
+        if len(self.pending_artifacts) >= ARTIFACT_BATCH_SIZE:
+            self.flush_artifacts(blackboard)
+
+    # Posts the queued artifacts in one call, so they are indexed together and
+    # the UI receives one event per artifact type instead of one per artifact
+    def flush_artifacts(self, blackboard):
+        if not self.pending_artifacts:
+            return
+        with self.current_metrics.phase("post_artifacts"):
+            self.post_artifacts(blackboard)
+
+    def post_artifacts(self, blackboard):
+        moduleName = NotificationAnalyzerDataSourceIngestModuleFactory.moduleName
+        if self.progress_bar:
+            self.progress_bar.progress("Posting " + str(len(self.pending_artifacts)) + " artifacts")
+        artifacts = ArrayList()
+        for artifact_type, art in self.pending_artifacts:
+            artifacts.add(art)
         try:
-            # Index the artifact for keyword search
-            blackboard.indexArtifact(artifact)
-        except Blackboard.BlackboardException as e:
-            self.log(Level.INFO, "Error indexing artifact " + artifact.getDisplayName() + " " +str(e))
-        # Fire an event to notify the UI and others that there is a new log artifact
-        IngestServices.getInstance().fireModuleDataEvent(
-            ModuleDataEvent(NotificationAnalyzerDataSourceIngestModuleFactory.moduleName,
-                            artifact_type, None))
+            if self.tsk_blackboard is None:
+                self.index_artifacts(blackboard, moduleName)
+            else:
+                self.tsk_blackboard.postArtifacts(artifacts, moduleName)
+        except AttributeError:
+            # Older Autopsy versions without the bulk post API
+            self.index_artifacts(blackboard, moduleName)
+        except (Exception, JavaException) as e:
+            self.log(Level.INFO, "Error posting artifacts " + str(e))
+        self.pending_artifacts = []
+
+    def index_artifacts(self, blackboard, moduleName):
+        by_type = {}
+        for artifact_type, art in self.pending_artifacts:
+            try:
+                # Index the artifact for keyword search
+                blackboard.indexArtifact(art)
+            except Blackboard.BlackboardException as e:
+                self.log(Level.INFO, "Error indexing artifact " + art.getDisplayName() + " " +str(e))
+            by_type.setdefault(artifact_type.getTypeID(), (artifact_type, ArrayList()))[1].add(art)
+        # Fire an event to notify the UI and others that there are new artifacts
+        for artifact_type, type_artifacts in by_type.itervalues():
+            IngestServices.getInstance().fireModuleDataEvent(
+                ModuleDataEvent(moduleName, artifact_type, type_artifacts))
 
     def create_artifact_type(self, art_name, art_desc, blackboard):
         try:
@@ -236,6 +617,143 @@ class NotificationAnalyzerDataSourceIngestModule(DataSourceIngestModule):
             self.log(Level.INFO, "Error getting or adding attribute type: " + att_desc + " " + str(e))
         return att_type
 
+# Parses one database on a worker thread of the ingest module's pool
+class NotificationDatabaseTask(Callable):
+
+    def __init__(self, module, file, work_dir, metrics):
+        self.module = module
+        self.file = file
+        self.work_dir = work_dir
+        self.metrics = metrics
+
+    def call(self):
+        try:
+            return (self.file, self.work_dir, self.module.parse_file(self.file, self.work_dir, self.metrics), self.metrics)
+        except (Exception, JavaException) as e:
+            self.module.log(Level.SEVERE, "Error processing " + self.file.getName() + ": " + str(e))
+            return (self.file, self.work_dir, None, self.metrics)
+
+# A NotifAnalyzer.py --serve process, parsing one database per JSON line request
+class AnalyzerWorker(object):
+
+    def __init__(self, python_path, log_path):
+        self.command = [python_path, PARSER_SCRIPT, '--serve']
+        self.log_path = log_path
+        self.proc = None
+        self.log_file = None
+        self.started = False
+        self.pid = None
+
+    def start(self):
+        self.started = True
+        self.log_file = open(self.log_path, 'a')
+        self.proc = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.log_file)
+        message = self.read(WORKER_START_TIMEOUT)
+        if message.get("status") != "ready":
+            raise IOError("Unexpected worker greeting: " + str(message))
+        self.pid = message.get("pid")
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def ping(self):
+        try:
+            return self.request({"command": "ping"}, WORKER_PING_TIMEOUT).get("status") == "ok"
+        except (Exception, JavaException):
+            return False
+
+    def request(self, message, timeout=None):
+        self.proc.stdin.write(json.dumps(message) + "\n")
+        self.proc.stdin.flush()
+        return self.read(timeout)
+
+    def read(self, timeout=None):
+        # A worker that does not answer in time is killed, which ends the blocked readline
+        timer = threading.Timer(timeout, self.kill) if timeout else None
+        if timer:
+            timer.start()
+        try:
+            while True:
+                line = self.proc.stdout.readline()
+                if not line:
+                    raise IOError("Parser worker exited with code " + str(self.proc.poll()))
+                message = json.loads(line)
+                # Streamed records are not requested by the ingest module
+                if "record" not in message:
+                    return message
+        finally:
+            if timer:
+                timer.cancel()
+
+    def stop(self):
+        if self.alive():
+            try:
+                self.request({"command": "shutdown"}, WORKER_PING_TIMEOUT)
+                self.proc.wait()
+            except (Exception, JavaException):
+                self.kill()
+        self.close()
+
+    def kill(self):
+        if self.alive():
+            try:
+                self.proc.kill()
+            except (Exception, JavaException):
+                pass
+
+    def close(self):
+        if self.log_file:
+            self.log_file.close()
+            self.log_file = None
+
+# Parser workers shared by the database tasks of an ingest job: an idle worker is
+# health checked before it is reused, a dead one is replaced
+class AnalyzerWorkerPool(object):
+
+    def __init__(self, python_path, temp_dir):
+        self.python_path = python_path
+        self.temp_dir = temp_dir
+        self.idle = Queue()
+        self.workers = []
+        self.started = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            try:
+                worker = self.idle.get_nowait()
+            except Empty:
+                break
+            if worker.alive() and worker.ping():
+                return worker
+            self.discard(worker)
+        with self.lock:
+            worker = AnalyzerWorker(self.python_path, os.path.join(self.temp_dir, "na-worker-" + str(self.started) + ".log"))
+            self.workers.append(worker)
+            self.started += 1
+        return worker
+
+    def release(self, worker):
+        self.idle.put(worker)
+
+    def discard(self, worker):
+        worker.kill()
+        worker.close()
+        with self.lock:
+            if worker in self.workers:
+                self.workers.remove(worker)
+
+    def stop(self, kill=False):
+        with self.lock:
+            workers = list(self.workers)
+            self.workers = []
+        for worker in workers:
+            if kill:
+                worker.kill()
+                worker.close()
+            else:
+                worker.stop()
+
 # UI that is shown to user for each ingest job so they can configure the job.
 class NotificationAnalyzerWithUISettingsPanel(IngestModuleIngestJobSettingsPanel):
     # Note, we can't use a self.settings instance variable.
@@ -254,30 +772,42 @@ class NotificationAnalyzerWithUISettingsPanel(IngestModuleIngestJobSettingsPanel
         self.initComponents()
         self.customizeComponents()
 
-    def checkBoxEventUndark(self, event):
-        if self.checkboxUndark.isSelected():
-            self.local_settings.setSetting("undark", "true")
+    def checkBoxEventRecover(self, event):
+        if self.checkboxRecover.isSelected():
+            self.local_settings.setSetting("recover", "true")
+        else:
+            self.local_settings.setSetting("recover", "false")
+
+    def checkBoxEventWal(self, event):
+        if self.checkboxWal.isSelected():
+            self.local_settings.setSetting("wal", "true")
+        else:
+            self.local_settings.setSetting("wal", "false")
+
+    def checkBoxEventMetrics(self, event):
+        if self.checkboxMetrics.isSelected():
+            self.local_settings.setSetting("metrics", "true")
         else:
-            self.local_settings.setSetting("undark", "false")
+            self.local_settings.setSetting("metrics", "false")
 
-    def checkBoxEventMdg(self, event):
-        if self.checkboxMdg.isSelected():
-            self.local_settings.setSetting("mdg", "true")
+    def checkBoxEventInProcess(self, event):
+        if self.checkboxInProcess.isSelected():
+            self.local_settings.setSetting("in_process", "true")
         else:
-            self.local_settings.setSetting("mdg", "false")
+            self.local_settings.setSetting("in_process", "false")
 
-    def checkBoxEventCrawler(self, event):
-        if self.checkboxCrawler.isSelected():
-            self.local_settings.setSetting("crawler", "true")
+    def checkBoxEventDecode(self, event):
+        if self.checkboxDecode.isSelected():
+            self.local_settings.setSetting("decode_payloads", "true")
         else:
-            self.local_settings.setSetting("crawler", "false")
+            self.local_settings.setSetting("decode_payloads", "false")
 
-    def checkBoxEventB2l(self, event):
-        if self.checkboxB2l.isSelected():
-            self.local_settings.setSetting("b2l", "true")
+    def checkBoxEventDedup(self, event):
+        if self.checkboxDedup.isSelected():
+            self.local_settings.setSetting("dedup", "true")
         else:
-            self.local_settings.setSetting("b2l", "false")
-    
+            self.local_settings.setSetting("dedup", "false")
+
     def textFieldEventPythonPath(self, event):
         self.local_settings.setSetting("python_path", self.textFieldPythonPath.getText())
 
@@ -292,41 +822,55 @@ class NotificationAnalyzerWithUISettingsPanel(IngestModuleIngestJobSettingsPanel
         self.textFieldPythonPath = JTextField(1)
         self.buttonSavePythonPath = JButton("Save", actionPerformed=self.textFieldEventPythonPath)
 
+        self.checkboxInProcess = JCheckBox("Parse in-process (SQLite JDBC, Python as fallback)", actionPerformed=self.checkBoxEventInProcess)
+        self.checkboxDecode = JCheckBox("Decode toast/tile/badge payloads", actionPerformed=self.checkBoxEventDecode)
+        self.checkboxMetrics = JCheckBox("Write per-phase metrics and profile the Python parser", actionPerformed=self.checkBoxEventMetrics)
+        self.checkboxDedup = JCheckBox("Skip records already found in another database of the case", actionPerformed=self.checkBoxEventDedup)
+
         self.labelCheckText = JLabel("Run recoveries: ")
 
-        self.checkboxUndark = JCheckBox("Undark", actionPerformed=self.checkBoxEventUndark)
-        self.checkboxMdg = JCheckBox("MGD Delete Parser", actionPerformed=self.checkBoxEventMdg)
-        self.checkboxCrawler = JCheckBox("WAL Crawler", actionPerformed=self.checkBoxEventCrawler)
-        self.checkboxB2l = JCheckBox("bring2lite", actionPerformed=self.checkBoxEventB2l)
+        self.checkboxRecover = JCheckBox("Carve deleted records (freelist and unallocated space)", actionPerformed=self.checkBoxEventRecover)
+        self.checkboxWal = JCheckBox("Read row versions from the WAL", actionPerformed=self.checkBoxEventWal)
         
-        self.checkboxUndark.setSelected(True)
-        self.checkboxMdg.setSelected(True)
+        self.checkboxRecover.setSelected(False)
         
         self.add(self.labelPythonPathText)
         panel1.add(self.textFieldPythonPath)
         panel1.add(self.buttonSavePythonPath)
+        panel1.add(self.checkboxInProcess)
+        panel1.add(self.checkboxDecode)
+        panel1.add(self.checkboxMetrics)
+        panel1.add(self.checkboxDedup)
 
         panel1.add(self.labelCheckText)
-        panel1.add(self.checkboxUndark)
-        panel1.add(self.checkboxMdg)
-        panel1.add(self.checkboxCrawler)
-        panel1.add(self.checkboxB2l)
+        panel1.add(self.checkboxRecover)
+        panel1.add(self.checkboxWal)
         self.add(panel1)
 
     def customizeComponents(self):
         # Set defaults if not set
-        if not self.local_settings.getSetting("undark"):
-            self.local_settings.setSetting("undark", "true")
-        if not self.local_settings.getSetting("mdg"):
-            self.local_settings.setSetting("mdg", "true")
+        if not self.local_settings.getSetting("recover"):
+            self.local_settings.setSetting("recover", "false")
+        if not self.local_settings.getSetting("wal"):
+            self.local_settings.setSetting("wal", "false")
+        if not self.local_settings.getSetting("in_process"):
+            self.local_settings.setSetting("in_process", "true")
+        if not self.local_settings.getSetting("decode_payloads"):
+            self.local_settings.setSetting("decode_payloads", "false")
+        if not self.local_settings.getSetting("metrics"):
+            self.local_settings.setSetting("metrics", "false")
+        if not self.local_settings.getSetting("dedup"):
+            self.local_settings.setSetting("dedup", "false")
         if not self.local_settings.getSetting("python_path"):
             self.local_settings.setSetting("python_path", "python")
 
         # Update checkboxes with stored settings
-        self.checkboxUndark.setSelected(self.local_settings.getSetting("undark") == "true")
-        self.checkboxMdg.setSelected(self.local_settings.getSetting("mdg") == "true")
-        self.checkboxCrawler.setSelected(self.local_settings.getSetting("crawler") == "true")
-        self.checkboxB2l.setSelected(self.local_settings.getSetting("b2l") == "true")
+        self.checkboxRecover.setSelected(self.local_settings.getSetting("recover") == "true")
+        self.checkboxWal.setSelected(self.local_settings.getSetting("wal") == "true")
+        self.checkboxInProcess.setSelected(self.local_settings.getSetting("in_process") == "true")
+        self.checkboxDecode.setSelected(self.local_settings.getSetting("decode_payloads") == "true")
+        self.checkboxMetrics.setSelected(self.local_settings.getSetting("metrics") == "true")
+        self.checkboxDedup.setSelected(self.local_settings.getSetting("dedup") == "true")
         self.textFieldPythonPath.setText(self.local_settings.getSetting("python_path"))
 
     # Return the settings used
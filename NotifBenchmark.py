@@ -0,0 +1,149 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from NotifAnalyzer import process_db, process_assets, QUERY_HANDLERS, QUERY_HANDLER_ASSETS, QUERY_NOTIFICATIONS
+from NotifRecords import to_json
+from NotifGenerator import generate_db, DEFAULT_HANDLERS, DEFAULT_ASSETS, DEFAULT_PAYLOAD_MEDIAN
+
+# Times the analyzer phases on generated databases of growing size, to catch
+# regressions and to size hardware for big cases
+
+DEFAULT_SIZES = (1000, 10000, 100000, 1000000)
+DEFAULT_SEED = 1
+DEFAULT_TOLERANCE = 0.2
+PHASES = ("process_db", "process_assets", "json")
+
+def run_benchmarks(sizes, work_dir, repeat=1, memory=True, decode_payloads=False, handlers=DEFAULT_HANDLERS,
+                   assets=DEFAULT_ASSETS, payload_median=DEFAULT_PAYLOAD_MEDIAN, phases=PHASES):
+    results = {"Platform": platform_info(), "DecodePayloads": decode_payloads, "Phases": list(phases), "Results": []}
+    for size in sizes:
+        file = os.path.join(work_dir, "bench-%d-%d-%d-%d.db" % (size, handlers, assets, payload_median))
+        # Databases are kept between runs, generating the biggest ones takes minutes
+        if not os.path.exists(file):
+            print('Generating ' + file)
+            generate_db(file, handlers, assets, size, payload_median, seed=DEFAULT_SEED)
+        for phase, run in phase_runners(file, decode_payloads, phases):
+            result = measure(run, repeat, memory)
+            result["Phase"] = phase
+            result["Notifications"] = size
+            result["RowsPerSecond"] = round(size / result["WallTime"]) if result["WallTime"] else None
+            results["Results"].append(result)
+            print_result(result)
+    return results
+
+def phase_runners(file, decode_payloads, phases=PHASES):
+    # The rows of the other phases are only loaded when one of them runs
+    if "process_db" in phases:
+        yield "process_db", lambda: process_db(file, decode_payloads)
+    if "process_assets" not in phases and "json" not in phases:
+        return
+    db_conn = sqlite3.connect(file)
+    db_conn.row_factory = sqlite3.Row
+    try:
+        handlers = db_conn.execute(QUERY_HANDLERS).fetchall()
+        assets = db_conn.execute(QUERY_HANDLER_ASSETS).fetchall()
+        notifications = db_conn.execute(QUERY_NOTIFICATIONS).fetchall()
+    finally:
+        db_conn.close()
+    if "process_assets" in phases:
+        yield "process_assets", lambda: process_assets(handlers, assets, notifications, decode_payloads)
+    if "json" in phases:
+        data = {"user_version": 0, "assets": process_assets(handlers, assets, notifications, decode_payloads)}
+        del handlers, assets, notifications
+        yield "json", lambda: json.dumps(data, indent=4, default=to_json)
+
+def measure(run, repeat, memory):
+    # Best wall time of the runs; peak memory comes from a separate traced run
+    # since tracemalloc slows the code down
+    wall_times = []
+    for i in range(repeat):
+        gc.collect()
+        start_time = time.perf_counter()
+        run()
+        wall_times.append(time.perf_counter() - start_time)
+    result = {"WallTime": round(min(wall_times), 4), "PeakMemory": None}
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            run()
+            result["PeakMemory"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+def platform_info():
+    return {"Python": platform.python_version(), "Implementation": platform.python_implementation(),
+            "System": platform.platform(), "Processor": platform.processor(), "CPUs": os.cpu_count()}
+
+def print_result(result):
+    memory = "%.1f MiB" % (result["PeakMemory"] / 1048576.0) if result["PeakMemory"] is not None else "-"
+    print("%-15s %10d notifications %10.3fs %12s rows/s %14s" % (
+        result["Phase"], result["Notifications"], result["WallTime"], result["RowsPerSecond"], memory))
+
+def compare(results, baseline, tolerance):
+    # Returns the phases and sizes slower (or bigger) than the baseline beyond the tolerance
+    previous = dict(((result["Phase"], result["Notifications"]), result) for result in baseline["Results"])
+    regressions = []
+    for result in results["Results"]:
+        old = previous.get((result["Phase"], result["Notifications"]))
+        if not old:
+            continue
+        for metric in ("WallTime", "PeakMemory"):
+            if result[metric] is None or not old[metric]:
+                continue
+            change = float(result[metric]) / old[metric] - 1
+            if change > tolerance:
+                regressions.append((result["Phase"], result["Notifications"], metric, old[metric], result[metric]))
+    return regressions
+
+def main(args):
+    start_time = time.time()
+    work_dir = args.dir or os.path.join(tempfile.gettempdir(), "notif-benchmark")
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    results = run_benchmarks(args.sizes, work_dir, args.repeat, not args.no_memory, args.decode_payloads,
+                             args.handlers, args.assets, args.payload_median, args.phases)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=4)
+    total_time = round(time.time() - start_time, 2)
+    print('Elapsed time: ' + str(total_time) + 's')
+    if args.baseline:
+        with open(args.baseline) as fp:
+            regressions = compare(results, json.load(fp), args.tolerance)
+        for phase, size, metric, old, new in regressions:
+            print("Regression: %s with %d notifications, %s %s -> %s" % (phase, size, metric, old, new))
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Notifications Analyzer benchmarks')
+    parser.add_argument('-n', '--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES),
+                        help='Notification counts of the generated databases')
+    parser.add_argument('-D', '--dir', type=str, default=None,
+                        help='Directory keeping the generated databases between runs')
+    parser.add_argument('-r', '--repeat', type=int, default=1, help='Runs per phase, the best time is kept')
+    parser.add_argument('-H', '--handlers', type=int, default=DEFAULT_HANDLERS, help='Number of notification handlers')
+    parser.add_argument('-a', '--assets', type=int, default=DEFAULT_ASSETS, help='Number of assets per handler')
+    parser.add_argument('-m', '--payload-median', type=int, default=DEFAULT_PAYLOAD_MEDIAN,
+                        help='Median payload size in bytes')
+    parser.add_argument('-P', '--phases', type=str, nargs='+', choices=PHASES, default=list(PHASES),
+                        help='Phases to time, all by default')
+    parser.add_argument('-d', '--decode-payloads', action='store_true', help='Decode the payloads while processing')
+    parser.add_argument('--no-memory', action='store_true', help='Skip the traced run measuring peak memory')
+    parser.add_argument('-o', '--output', type=str, default=None, help='Path of the JSON results')
+    parser.add_argument('-b', '--baseline', type=str, default=None,
+                        help='JSON results of a previous run; exits with 1 on regressions')
+    parser.add_argument('-t', '--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Allowed slowdown or memory growth over the baseline (0.2 is 20%%)')
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,317 @@
+import mmap
+import os
+import sqlite3
+import struct
+from multiprocessing import Pool
+from urllib.request import pathname2url
+
+# Recovers deleted Notification and NotificationHandler records from the freelist
+# pages and the unallocated space of the live pages of a wpndatabase.db
+
+HEADER_SIZE = 100
+TABLE_LEAF_PAGE = 0x0D
+ENCODINGS = {1: "utf-8", 2: "utf-16-le", 3: "utf-16-be"}
+# Plausible FILETIME values: years 2000 to 2100
+FILETIME_MIN = 125911584000000000
+FILETIME_MAX = 157766880000000000
+PAGES_PER_TASK = 256
+CARVED_TABLES = ("NotificationHandler", "Notification")
+QUERY_TABLE_INFO = 'PRAGMA table_info("{}")'
+INVALID = object()
+
+# Column layout of Windows 10 wpndatabase.db, used when the live schema cannot be read
+DEFAULT_SCHEMAS = {
+    "NotificationHandler": [
+        ("RecordId", "INTEGER", True, True), ("PrimaryId", "TEXT", True, False),
+        ("HandlerType", "TEXT", True, False), ("WNSId", "TEXT", False, False),
+        ("WNFEventName", "INT64", False, False), ("SystemDataPropertySet", "BLOB", False, False),
+        ("CreatedTime", "INT64", True, False), ("ModifiedTime", "INT64", True, False),
+        ("ParentId", "INTEGER", False, False)],
+    "Notification": [
+        ("Order", "INTEGER", True, True), ("Id", "INTEGER", True, False),
+        ("HandlerId", "INTEGER", True, False), ("ActivityId", "GUID", False, False),
+        ("Type", "TEXT", True, False), ("Payload", "BLOB", False, False),
+        ("Tag", "TEXT", True, False), ("Group", "TEXT", True, False),
+        ("ExpiryTime", "INT64", True, False), ("ArrivalTime", "INT64", True, False),
+        ("DataVersion", "INTEGER", True, False), ("PayloadType", "TEXT", True, False),
+        ("BootId", "INT64", False, False), ("ExpiresOnReboot", "BOOLEAN", True, False)],
+}
+
+def carve_db(file, workers=None):
+    # Returns {table name: [record dict]} with the carved records of each table
+    schemas = read_schemas(file)
+    with open(file, 'rb') as fp:
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            page_size, encoding = read_header(data)
+            num_pages = len(data) // page_size
+            freelist = set(read_freelist(data, page_size, num_pages))
+        finally:
+            data.close()
+    pages = list(range(1, num_pages + 1))
+    tasks = [(file, page_size, encoding, schemas, freelist.intersection(pages[i:i + PAGES_PER_TASK]),
+              pages[i], min(pages[i] + PAGES_PER_TASK, num_pages + 1))
+             for i in range(0, len(pages), PAGES_PER_TASK)]
+    if workers == 1 or len(tasks) <= 1:
+        results = [carve_pages(task) for task in tasks]
+    else:
+        pool = Pool(workers)
+        try:
+            results = pool.map(carve_pages, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    carved = dict((table, []) for table in schemas)
+    for result in results:
+        for table, records in result.items():
+            carved[table].extend(records)
+    return carved
+
+def read_schemas(file):
+    schemas = {}
+    try:
+        # Opened as immutable so SQLite neither locks the file nor checkpoints its WAL
+        db_conn = sqlite3.connect("file:" + pathname2url(os.path.abspath(file)) + "?immutable=1", uri=True)
+        try:
+            for table in CARVED_TABLES:
+                rows = db_conn.execute(QUERY_TABLE_INFO.format(table)).fetchall()
+                # (cid, name, type, notnull, default, pk); an INTEGER PRIMARY KEY is the rowid
+                schemas[table] = [(row[1], row[2].upper(), bool(row[3]) or row[5] == 1,
+                                   row[5] == 1 and row[2].upper() == "INTEGER") for row in rows]
+        finally:
+            db_conn.close()
+    except sqlite3.Error:
+        pass
+    for table in CARVED_TABLES:
+        if not schemas.get(table):
+            schemas[table] = DEFAULT_SCHEMAS[table]
+    return schemas
+
+def read_header(data):
+    page_size = struct.unpack(">H", data[16:18])[0]
+    if page_size == 1:
+        page_size = 65536
+    encoding = ENCODINGS.get(struct.unpack(">I", data[56:60])[0], "utf-8")
+    return page_size, encoding
+
+def read_freelist(data, page_size, num_pages):
+    trunk = struct.unpack(">I", data[32:36])[0]
+    seen = set()
+    while 0 < trunk <= num_pages and trunk not in seen:
+        seen.add(trunk)
+        yield trunk
+        offset = (trunk - 1) * page_size
+        next_trunk, count = struct.unpack(">II", data[offset:offset + 8])
+        count = min(count, (page_size - 8) // 4)
+        for leaf in struct.unpack(">" + "I" * count, data[offset + 8:offset + 8 + count * 4]):
+            if 0 < leaf <= num_pages:
+                yield leaf
+        trunk = next_trunk
+
+def carve_pages(task):
+    file, page_size, encoding, schemas, freelist, first_page, last_page = task
+    layouts = dict((table, column_layout(columns)) for table, columns in schemas.items())
+    carved = dict((table, []) for table in schemas)
+    with open(file, 'rb') as fp:
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for page in range(first_page, last_page):
+                for start, end in unallocated_regions(data, page, page_size, page in freelist):
+                    for table, record in carve_region(data, start, end, layouts, encoding):
+                        record["Page"] = page
+                        carved[table].append(record)
+        finally:
+            data.close()
+    return carved
+
+def unallocated_regions(data, page, page_size, is_free):
+    offset = (page - 1) * page_size
+    if is_free:
+        # Freelist pages keep their old content; trunk pages lose the first bytes
+        return [(offset, offset + page_size)]
+    header = offset + HEADER_SIZE if page == 1 else offset
+    # Only table leaf pages hold records; overflow pages have no header to tell
+    # live from deleted content
+    if data[header] != TABLE_LEAF_PAGE:
+        return []
+    first_freeblock, num_cells, content_start = struct.unpack(">HHH", data[header + 1:header + 7])
+    content_start = content_start or 65536
+    regions = []
+    pointers_end = header + 8 + num_cells * 2
+    if offset + content_start > pointers_end:
+        regions.append((pointers_end, offset + content_start))
+    freeblock = first_freeblock
+    seen = set()
+    while freeblock and freeblock not in seen and freeblock < page_size - 4:
+        seen.add(freeblock)
+        next_block, size = struct.unpack(">HH", data[offset + freeblock:offset + freeblock + 4])
+        regions.append((offset + freeblock, offset + min(freeblock + size, page_size)))
+        freeblock = next_block
+    return regions
+
+def column_layout(columns):
+    # (name, accepted serial type check, not null, rowid alias)
+    return [(name, serial_type_check(declared_type), notnull, rowid) for name, declared_type, notnull, rowid in columns]
+
+def serial_type_check(declared_type):
+    if "INT" in declared_type:
+        return lambda serial_type: serial_type <= 9 and serial_type != 7
+    if "CHAR" in declared_type or "CLOB" in declared_type or "TEXT" in declared_type:
+        return lambda serial_type: serial_type == 0 or (serial_type >= 13 and serial_type % 2 == 1)
+    return lambda serial_type: serial_type <= 9 or serial_type >= 12
+
+def carve_region(data, start, end, layouts, encoding):
+    i = start
+    while i < end:
+        match = carve_record(data, start, i, end, layouts, encoding)
+        if match:
+            table, record, record_end = match
+            yield table, record
+            i = record_end
+        else:
+            i += 1
+
+def carve_record(data, start, offset, end, layouts, encoding):
+    for table, layout in layouts.items():
+        match = parse_record(data, offset, end, layout, encoding)
+        if match:
+            record, record_end = match
+            record["Offset"] = offset
+            record["RowId"] = find_rowid(data, start, offset, record_end - offset)
+            return table, record, record_end
+    # A freed cell starts with a 4 byte freeblock header (next offset, size) that
+    # overwrote the payload size, the rowid, the record header size and maybe the
+    # first serial type
+    if offset - 4 < start:
+        return None
+    freeblock_end = offset - 4 + struct.unpack(">H", data[offset - 2:offset])[0]
+    if not offset < freeblock_end <= end:
+        return None
+    for table, layout in layouts.items():
+        match = parse_freeblock_record(data, offset, freeblock_end, layout, encoding)
+        if match:
+            record, record_end = match
+            record["Offset"] = offset - 4
+            record["RowId"] = None
+            return table, record, record_end
+    return None
+
+def parse_record(data, offset, end, layout, encoding):
+    num_columns = len(layout)
+    header_size = data[offset]
+    # Headers of these tables always fit in a one byte varint
+    if header_size <= num_columns or header_size > num_columns * 9 + 1 or header_size >= 0x80:
+        return None
+    header_end = offset + header_size
+    if header_end > end:
+        return None
+    serial_types = parse_serial_types(data, offset + 1, header_end, layout, 0)
+    if not serial_types or serial_types[1] != header_end:
+        return None
+    return parse_body(data, header_end, end, layout, serial_types[0], encoding)
+
+def parse_freeblock_record(data, offset, end, layout, encoding):
+    # Only the serial types of rowid aliases, always 0, can be assumed when lost
+    for lost in (0, 1):
+        serial_types = parse_serial_types(data, offset, end, layout, lost)
+        if serial_types:
+            match = parse_body(data, serial_types[1], end, layout, serial_types[0], encoding)
+            if match:
+                return match
+    return None
+
+def parse_serial_types(data, position, header_end, layout, lost):
+    serial_types = []
+    for index, (name, check, notnull, rowid) in enumerate(layout):
+        if index < lost:
+            if not rowid:
+                return None
+            serial_types.append(0)
+            continue
+        if position >= header_end:
+            return None
+        serial_type, position = read_varint(data, position)
+        if not check(serial_type):
+            return None
+        if rowid and serial_type != 0:
+            return None
+        if notnull and not rowid and serial_type == 0:
+            return None
+        serial_types.append(serial_type)
+    return serial_types, position
+
+def parse_body(data, position, end, layout, serial_types, encoding):
+    record = {}
+    for (name, check, notnull, rowid), serial_type in zip(layout, serial_types):
+        size = serial_type_size(serial_type)
+        if position + size > end:
+            return None
+        value = decode_value(data[position:position + size], serial_type, encoding)
+        if value is INVALID:
+            return None
+        record[name] = value
+        position += size
+    if not plausible_times(record):
+        return None
+    return record, position
+
+def find_rowid(data, region_start, record_start, record_size):
+    # An intact cell starts with the payload size and the rowid as varints
+    for cell_start in range(max(region_start, record_start - 18), record_start):
+        payload_size, position = read_varint(data, cell_start)
+        if payload_size != record_size:
+            continue
+        rowid, position = read_varint(data, position)
+        if position == record_start:
+            return rowid
+    return None
+
+def plausible_times(record):
+    found = False
+    for name, value in record.items():
+        if not name.endswith("Time") or value is None or value == 0:
+            continue
+        if not isinstance(value, int) or not FILETIME_MIN <= value <= FILETIME_MAX:
+            return False
+        found = True
+    return found
+
+def decode_value(raw, serial_type, encoding):
+    if serial_type == 0:
+        return None
+    if 1 <= serial_type <= 6:
+        return int.from_bytes(raw, "big", signed=True)
+    if serial_type == 7:
+        return struct.unpack(">d", raw)[0]
+    if serial_type == 8:
+        return 0
+    if serial_type == 9:
+        return 1
+    if serial_type >= 13 and serial_type % 2 == 1:
+        try:
+            return raw.decode(encoding)
+        except UnicodeDecodeError:
+            return INVALID
+    if serial_type >= 12:
+        return bytes(raw)
+    return INVALID
+
+def serial_type_size(serial_type):
+    if serial_type >= 12:
+        return (serial_type - 12) // 2
+    return (0, 1, 2, 3, 4, 6, 8, 8, 0, 0, 0, 0)[serial_type]
+
+def read_varint(data, position):
+    value = 0
+    for i in range(8):
+        if position >= len(data):
+            return value, position
+        byte = data[position]
+        position += 1
+        value = (value << 7) | (byte & 0x7f)
+        if byte < 0x80:
+            return value, position
+    if position < len(data):
+        value = (value << 8) | data[position]
+        position += 1
+    return value, position
@@ -0,0 +1,287 @@
+import argparse
+import hashlib
+import json
+import sys
+import time
+from NotifTimeline import notification_id
+
+# Kept compatible with Python 2 so the Jython ingest module shares the index
+# format with the command line. A SQLite file per case, keyed by content hash,
+# remembers the first source of every handler and notification and every source
+# it was seen in after, so snapshots and re-collections of the same machine only
+# add what is new. Lookups go through the primary key in batches, which stays
+# fast with millions of hashes
+
+DEDUP_TIMEOUT = 60
+# Host parameters per lookup, below the SQLite default limit of 999
+DEDUP_LOOKUP_SIZE = 500
+# Records of a stream checked against the index at once
+DEDUP_BATCH_SIZE = 10000
+FIRST_SOURCE = "FirstSource"
+DUPLICATE = "duplicate"
+KIND_HANDLER = "handler"
+KIND_NOTIFICATION = "notification"
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS sources (SourceId INTEGER PRIMARY KEY, Path TEXT UNIQUE NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS records (Hash TEXT PRIMARY KEY, Kind TEXT NOT NULL, FirstSource INTEGER NOT NULL) '
+    'WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS occurrences (Hash TEXT NOT NULL, SourceId INTEGER NOT NULL, '
+    'PRIMARY KEY (Hash, SourceId)) WITHOUT ROWID',
+)
+
+def connect(path):
+    # Jython has no sqlite3 module, the SQLite JDBC driver shipped with Autopsy is used instead
+    if sys.platform.startswith("java"):
+        from com.ziclix.python.sql import zxJDBC
+        return zxJDBC.connect("jdbc:sqlite:" + path, None, None, "org.sqlite.JDBC")
+    import sqlite3
+    return sqlite3.connect(path, timeout=DEDUP_TIMEOUT)
+
+def handler_key(handler):
+    # A handler keeps its primary id, type and creation time across snapshots,
+    # while its modification time and row id change. Handlers without a primary
+    # id (placeholders of recovered notifications, partly carved records) have
+    # no identity to compare and are never duplicates
+    if handler.get("HandlerPrimaryId") is None:
+        return None
+    parts = (KIND_HANDLER, handler.get("HandlerPrimaryId"), handler.get("HandlerType"), handler.get("CreatedTime"))
+    return hashlib.sha1(u"\x00".join(u"%s" % (part,) for part in parts).encode("utf-8")).hexdigest()
+
+class DedupIndex(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = connect(path)
+        self.source_ids = {}
+        self.source_paths = {}
+        # Duplicates found per kind since the index was opened
+        self.duplicates = {KIND_HANDLER: 0, KIND_NOTIFICATION: 0}
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute('PRAGMA journal_mode = WAL')
+            cursor.execute('PRAGMA synchronous = NORMAL')
+            for statement in SCHEMA:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
+        self.conn.commit()
+
+    def source_id(self, source):
+        if source in self.source_ids:
+            return self.source_ids[source]
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute('INSERT OR IGNORE INTO sources (Path) VALUES (?)', (source,))
+            cursor.execute('SELECT SourceId FROM sources WHERE Path = ?', (source,))
+            source_id = int(cursor.fetchone()[0])
+        finally:
+            cursor.close()
+        self.conn.commit()
+        self.source_ids[source] = source_id
+        self.source_paths[source_id] = source
+        return source_id
+
+    def source_path(self, source_id):
+        if source_id not in self.source_paths:
+            cursor = self.conn.cursor()
+            try:
+                cursor.execute('SELECT Path FROM sources WHERE SourceId = ?', (source_id,))
+                self.source_paths[source_id] = cursor.fetchone()[0]
+            finally:
+                cursor.close()
+        return self.source_paths[source_id]
+
+    def add(self, source, keys):
+        # keys are (hash, kind) pairs found in source; returns {hash: first source}
+        # of those first found in another source. Copies within the same source,
+        # or a source processed again, are not duplicates. The records are inserted
+        # before being looked up, so processes sharing the index agree on the first one
+        source_id = self.source_id(source)
+        kinds = {}
+        for key, kind in keys:
+            kinds.setdefault(key, kind)
+        hashes = list(kinds)
+        first_sources = {}
+        cursor = self.conn.cursor()
+        try:
+            if hashes:
+                cursor.executemany('INSERT OR IGNORE INTO records (Hash, Kind, FirstSource) VALUES (?, ?, ?)',
+                                   [(key, kinds[key], source_id) for key in hashes])
+                cursor.executemany('INSERT OR IGNORE INTO occurrences (Hash, SourceId) VALUES (?, ?)',
+                                   [(key, source_id) for key in hashes])
+            for start in range(0, len(hashes), DEDUP_LOOKUP_SIZE):
+                chunk = hashes[start:start + DEDUP_LOOKUP_SIZE]
+                cursor.execute('SELECT Hash, FirstSource FROM records WHERE FirstSource != ? AND Hash IN (%s)' %
+                               ", ".join("?" * len(chunk)), [source_id] + chunk)
+                for key, first_source in cursor.fetchall():
+                    first_sources[key] = int(first_source)
+        finally:
+            cursor.close()
+        self.conn.commit()
+        duplicates = {}
+        for key, first_source in first_sources.items():
+            duplicates[key] = self.source_path(first_source)
+            self.duplicates[kinds[key]] += 1
+        return duplicates
+
+    def sources(self, keys):
+        # {hash: every source it was found in, the first one first}
+        keys = list(keys)
+        sources = dict((key, []) for key in keys)
+        cursor = self.conn.cursor()
+        try:
+            for start in range(0, len(keys), DEDUP_LOOKUP_SIZE):
+                chunk = keys[start:start + DEDUP_LOOKUP_SIZE]
+                cursor.execute('SELECT occurrences.Hash, sources.Path FROM occurrences '
+                               'JOIN sources ON sources.SourceId = occurrences.SourceId '
+                               'JOIN records ON records.Hash = occurrences.Hash '
+                               'WHERE occurrences.Hash IN (%s) ORDER BY occurrences.Hash, '
+                               'occurrences.SourceId != records.FirstSource, sources.SourceId' %
+                               ", ".join("?" * len(chunk)), chunk)
+                for key, path in cursor.fetchall():
+                    sources[key].append(path)
+        finally:
+            cursor.close()
+        return sources
+
+    def links(self, source=None, key=None):
+        # Links of the records found in more than one source, optionally only those
+        # found in source or the one record with hash key
+        query = 'SELECT records.Hash, records.Kind, sources.Path FROM records ' \
+                'JOIN sources ON sources.SourceId = records.FirstSource ' \
+                'WHERE EXISTS (SELECT 1 FROM occurrences WHERE occurrences.Hash = records.Hash ' \
+                'AND occurrences.SourceId != records.FirstSource)'
+        parameters = []
+        if source is not None:
+            query += ' AND EXISTS (SELECT 1 FROM occurrences JOIN sources ON sources.SourceId = occurrences.SourceId ' \
+                     'WHERE occurrences.Hash = records.Hash AND sources.Path = ?)'
+            parameters.append(source)
+        if key is not None:
+            query += ' AND records.Hash = ?'
+            parameters.append(key)
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(query, parameters)
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+        sources = self.sources(row[0] for row in rows)
+        return [duplicate_link(key, kind, None, first_source, sources[key]) for key, kind, first_source in rows]
+
+    def close(self):
+        self.conn.close()
+
+def duplicate_link(key, kind, handler_id, first_source, sources):
+    return {"Id": key, "Kind": kind, "HandlerId": handler_id, FIRST_SOURCE: first_source, "Sources": sources}
+
+def dedup_assets(index, source, assets):
+    # Drops the notifications of a processed database found in an earlier source,
+    # and the handlers left without notifications that were found there too. Kept
+    # handlers found earlier are tagged with their FirstSource. Returns the links
+    # of the dropped records to their first occurrence and all their sources
+    keys = []
+    handler_keys = {}
+    notification_keys = {}
+    for id, handler in assets.items():
+        handler_keys[id] = handler_key(handler)
+        notification_keys[id] = [notification_id(handler, notification) for notification in handler["Notifications"]]
+        if handler_keys[id]:
+            keys.append((handler_keys[id], KIND_HANDLER))
+        keys.extend((key, KIND_NOTIFICATION) for key in notification_keys[id])
+    duplicates = index.add(source, keys)
+    if not duplicates:
+        return []
+    dropped = []
+    for id, handler in list(assets.items()):
+        notifications = []
+        for notification, key in zip(handler["Notifications"], notification_keys[id]):
+            if key in duplicates:
+                dropped.append((key, KIND_NOTIFICATION, id))
+            else:
+                notifications.append(notification)
+        emptied = bool(handler["Notifications"]) and not notifications
+        handler["Notifications"] = notifications
+        first_source = duplicates.get(handler_keys[id])
+        if notifications:
+            if first_source is not None:
+                handler[FIRST_SOURCE] = first_source
+        elif first_source is not None:
+            dropped.append((handler_keys[id], KIND_HANDLER, id))
+            del assets[id]
+        elif emptied and handler_keys[id] is None:
+            # A placeholder left without any of the notifications it was made for
+            del assets[id]
+    sources = index.sources(set(key for key, kind, id in dropped))
+    return [duplicate_link(key, kind, id, duplicates[key], sources[key]) for key, kind, id in dropped]
+
+def dedup_records(index, source, records, batch_size=DEDUP_BATCH_SIZE):
+    # Same for the records of NotifAnalyzer.stream_db, checked in batches. A
+    # duplicate handler is held back until one of its notifications is new, and
+    # each dropped record is replaced by a "duplicate" link record
+    handlers = {}
+    held = {}
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            for kept in dedup_batch(index, source, batch, handlers, held):
+                yield kept
+            batch = []
+    for kept in dedup_batch(index, source, batch, handlers, held):
+        yield kept
+    sources = index.sources(key for record, key, first_source in held.values())
+    for id, (record, key, first_source) in held.items():
+        yield link_record(key, KIND_HANDLER, id, first_source, sources[key])
+
+def dedup_batch(index, source, batch, handlers, held):
+    keys = []
+    for record in batch:
+        record_type = record.get("RecordType")
+        key = None
+        if record_type == KIND_HANDLER:
+            handlers[record["HandlerId"]] = record
+            key = handler_key(record)
+        elif record_type == KIND_NOTIFICATION:
+            key = notification_id(handlers.get(record["HandlerId"], {}), record)
+        keys.append((key, record_type) if key else None)
+    duplicates = index.add(source, [key for key in keys if key])
+    sources = index.sources(set(key[0] for key in keys if key and key[1] == KIND_NOTIFICATION and key[0] in duplicates))
+    for record, key in zip(batch, keys):
+        first_source = duplicates.get(key[0]) if key else None
+        if first_source is None:
+            if key and key[1] == KIND_NOTIFICATION:
+                held_handler = held.pop(record["HandlerId"], None)
+                if held_handler is not None:
+                    yield held_handler[0]
+            yield record
+        elif key[1] == KIND_HANDLER:
+            record[FIRST_SOURCE] = first_source
+            held[record["HandlerId"]] = (record, key[0], first_source)
+        else:
+            yield link_record(key[0], KIND_NOTIFICATION, record["HandlerId"], first_source, sources[key[0]])
+
+def link_record(key, kind, handler_id, first_source, sources):
+    link = duplicate_link(key, kind, handler_id, first_source, sources)
+    link["RecordType"] = DUPLICATE
+    return link
+
+def main(args):
+    start_time = time.time()
+    index = DedupIndex(args.index)
+    try:
+        json.dump(index.links(args.source, args.id), sys.stdout, indent=4)
+        print("")
+    finally:
+        index.close()
+    sys.stderr.write('Elapsed time: ' + str(round(time.time() - start_time, 2)) + 's\n')
+
+def setup_args():
+    parser = argparse.ArgumentParser(description='Records found in more than one database of a deduplication index')
+    parser.add_argument('-i', '--index', type=str, required=True, help='Path to the deduplication index (SQLite)')
+    parser.add_argument('--source', type=str, default=None, help='Only the duplicates found in this database')
+    parser.add_argument('--id', type=str, default=None, help='Only the record with this hash')
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = setup_args()
+    main(args)
@@ -0,0 +1,178 @@
+import os
+import shutil
+import sqlite3
+from NotifTimeline import filetime_to_epoch
+
+# Writes the handlers, assets and notifications of an analysis as normalized
+# tables, either in a results SQLite database or in Parquet files, with the
+# FILETIME columns decoded to epoch seconds. The WAL version history read with
+# -W goes to its own table, one row per version
+
+EXPORT_BATCH_SIZE = 10000
+PARQUET_ROW_GROUP_SIZE = 65536
+
+SCHEMA = '''
+CREATE TABLE database (UserVersion INTEGER);
+CREATE TABLE handlers (HandlerId INTEGER, PrimaryId TEXT, AppName TEXT, ParentId INTEGER, WNSId TEXT,
+    HandlerType TEXT, WNFEventName INTEGER, SystemDataPropertySet TEXT, CreatedTime INTEGER, CreatedEpoch INTEGER,
+    ModifiedTime INTEGER, ModifiedEpoch INTEGER, Recovered INTEGER NOT NULL);
+CREATE TABLE assets (HandlerId INTEGER, AssetKey TEXT, AssetValue TEXT);
+CREATE TABLE notifications (NotificationId INTEGER PRIMARY KEY, HandlerId INTEGER, Type TEXT, PayloadType TEXT,
+    Payload TEXT, Text TEXT, ArrivalTime INTEGER, ArrivalEpoch INTEGER, ExpiryTime INTEGER, ExpiryEpoch INTEGER,
+    Recovered INTEGER NOT NULL);
+CREATE TABLE wal_versions (WalTable TEXT, RowId INTEGER, Frame INTEGER, LastSeenFrame INTEGER, Page INTEGER,
+    Salt TEXT, State TEXT, Live INTEGER NOT NULL, HandlerId INTEGER, PrimaryId TEXT, HandlerType TEXT,
+    ModifiedTime INTEGER, ModifiedEpoch INTEGER, Type TEXT, PayloadType TEXT, Payload TEXT, ArrivalTime INTEGER,
+    ArrivalEpoch INTEGER, ExpiryTime INTEGER, ExpiryEpoch INTEGER);
+CREATE TABLE duplicates (Id TEXT, Kind TEXT, HandlerId INTEGER, FirstSource TEXT, Sources TEXT);
+'''
+# Built after the bulk inserts, which is much faster than updating them row by row
+INDEXES = '''
+CREATE INDEX handlers_handler ON handlers (HandlerId);
+CREATE INDEX handlers_app_name ON handlers (AppName);
+CREATE INDEX assets_handler ON assets (HandlerId);
+CREATE INDEX notifications_arrival ON notifications (ArrivalEpoch);
+CREATE INDEX notifications_handler_arrival ON notifications (HandlerId, ArrivalEpoch);
+CREATE INDEX wal_versions_row ON wal_versions (WalTable, RowId, Frame);
+CREATE INDEX duplicates_id ON duplicates (Id);
+'''
+HANDLER_COLUMNS = ("HandlerId", "PrimaryId", "AppName", "ParentId", "WNSId", "HandlerType", "WNFEventName",
+                   "SystemDataPropertySet", "CreatedTime", "CreatedEpoch", "ModifiedTime", "ModifiedEpoch", "Recovered")
+ASSET_COLUMNS = ("HandlerId", "AssetKey", "AssetValue")
+NOTIFICATION_COLUMNS = ("HandlerId", "Type", "PayloadType", "Payload", "Text", "ArrivalTime", "ArrivalEpoch",
+                        "ExpiryTime", "ExpiryEpoch", "Recovered")
+WAL_VERSION_COLUMNS = ("WalTable", "RowId", "Frame", "LastSeenFrame", "Page", "Salt", "State", "Live", "HandlerId",
+                       "PrimaryId", "HandlerType", "ModifiedTime", "ModifiedEpoch", "Type", "PayloadType", "Payload",
+                       "ArrivalTime", "ArrivalEpoch", "ExpiryTime", "ExpiryEpoch")
+# Records left out with --dedup, linked to the databases they were found in (one path per line)
+DUPLICATE_COLUMNS = ("Id", "Kind", "HandlerId", "FirstSource", "Sources")
+TABLE_COLUMNS = {"handlers": HANDLER_COLUMNS, "assets": ASSET_COLUMNS, "notifications": NOTIFICATION_COLUMNS,
+                 "wal_versions": WAL_VERSION_COLUMNS, "duplicates": DUPLICATE_COLUMNS}
+INSERTS = dict((table, 'INSERT INTO %s (%s) VALUES (%s)' % (table, ", ".join(columns), ", ".join("?" * len(columns))))
+               for table, columns in TABLE_COLUMNS.items())
+
+def export_sqlite(records, path):
+    # Consumes the records of NotifAnalyzer.stream_db, so notifications are never
+    # all held in memory. Returns the number of rows written per table
+    temp_path = path + ".tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    try:
+        counts = write_sqlite(records, temp_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    os.replace(temp_path, path)
+    return counts
+
+def write_sqlite(records, path):
+    counts = dict((table, 0) for table in TABLE_COLUMNS)
+    db_conn = sqlite3.connect(path)
+    try:
+        # A new file that is only renamed once complete needs no journal
+        db_conn.execute('PRAGMA journal_mode = OFF')
+        db_conn.execute('PRAGMA synchronous = OFF')
+        db_conn.executescript(SCHEMA)
+        pending = dict((table, []) for table in TABLE_COLUMNS)
+        with db_conn:
+            for table, row in table_rows(records):
+                if table == "database":
+                    db_conn.execute('INSERT INTO database (UserVersion) VALUES (?)', row)
+                    continue
+                pending[table].append(row)
+                if len(pending[table]) == EXPORT_BATCH_SIZE:
+                    db_conn.executemany(INSERTS[table], pending[table])
+                    counts[table] += len(pending[table])
+                    pending[table] = []
+            for table, rows in pending.items():
+                db_conn.executemany(INSERTS[table], rows)
+                counts[table] += len(rows)
+        db_conn.executescript(INDEXES)
+        db_conn.execute('ANALYZE')
+    finally:
+        db_conn.close()
+    return counts
+
+def export_parquet(records, path):
+    # Writes handlers.parquet, assets.parquet and notifications.parquet in the path
+    # directory. Notifications are sorted by arrival, so readers skip the row groups
+    # outside a time range from their statistics
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError("Parquet export requires pyarrow (pip install pyarrow)")
+    columns = dict((table, dict((column, []) for column in table_columns))
+                   for table, table_columns in TABLE_COLUMNS.items())
+    user_version = None
+    for table, row in table_rows(records):
+        if table == "database":
+            user_version = row[0]
+            continue
+        for column, value in zip(TABLE_COLUMNS[table], row):
+            columns[table][column].append(value)
+    notifications = columns["notifications"]
+    order = sorted(range(len(notifications["ArrivalEpoch"])),
+                   key=lambda i: (notifications["ArrivalEpoch"][i] is None, notifications["ArrivalEpoch"][i] or 0))
+    for column, values in notifications.items():
+        notifications[column] = [values[i] for i in order]
+    temp_path = path + ".tmp"
+    if os.path.exists(temp_path):
+        shutil.rmtree(temp_path)
+    os.makedirs(temp_path)
+    counts = {}
+    for table, table_columns in columns.items():
+        arrow_table = pyarrow.table(table_columns)
+        arrow_table = arrow_table.replace_schema_metadata({"user_version": str(user_version)})
+        pyarrow.parquet.write_table(arrow_table, os.path.join(temp_path, table + ".parquet"),
+                                    row_group_size=PARQUET_ROW_GROUP_SIZE)
+        counts[table] = arrow_table.num_rows
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(temp_path, path)
+    return counts
+
+def table_rows(records):
+    # Yields (table, row) in the column order of TABLE_COLUMNS
+    for record in records:
+        record_type = record.get("RecordType")
+        if record_type == "database":
+            yield "database", (record["user_version"],)
+        elif record_type == "handler":
+            yield "handlers", handler_row(record)
+            for asset in record["OtherAssets"]:
+                for key, value in asset.items():
+                    yield "assets", (record["HandlerId"], key, value)
+        elif record_type == "notification":
+            yield "notifications", notification_row(record)
+        elif record_type == "duplicate":
+            yield "duplicates", (record["Id"], record["Kind"], record["HandlerId"], record["FirstSource"],
+                                 "\n".join(record["Sources"]))
+        elif record_type == "wal_history":
+            for version in record["Versions"]:
+                yield "wal_versions", wal_version_row(record, version)
+
+def handler_row(handler):
+    return (handler["HandlerId"], handler["HandlerPrimaryId"], handler.get("AppName"), handler["ParentId"],
+            handler["WNSId"], handler["HandlerType"], handler["WNFEventName"], handler["SystemDataPropertySet"],
+            handler["CreatedTime"], filetime_to_epoch(handler["CreatedTime"]),
+            handler["ModifiedTime"], filetime_to_epoch(handler["ModifiedTime"]), int(bool(handler.get("Recovered"))))
+
+def notification_row(notification):
+    decoded = notification.get("DecodedPayload")
+    text = "\n".join(decoded["Text"]) if decoded and decoded["Text"] else None
+    return (notification["HandlerId"], notification["Type"], notification["PayloadType"], notification["Payload"],
+            text, notification["ArrivalTime"], filetime_to_epoch(notification["ArrivalTime"]),
+            notification["ExpiryTime"], filetime_to_epoch(notification["ExpiryTime"]),
+            int(bool(notification.get("Recovered"))))
+
+def wal_version_row(entry, version):
+    # Handler and notification versions share the table, the columns of the other kind are NULL
+    record = version["Record"]
+    return (entry["Table"], entry["RowId"], version["Frame"], version["LastSeenFrame"], version["Page"],
+            version["Salt"], version["State"], int(bool(version.get("Live"))), record.get("HandlerId"),
+            record.get("HandlerPrimaryId"), record.get("HandlerType"), record.get("ModifiedTime"),
+            filetime_to_epoch(record.get("ModifiedTime")), record.get("Type"), record.get("PayloadType"),
+            record.get("Payload"), record.get("ArrivalTime"), filetime_to_epoch(record.get("ArrivalTime")),
+            record.get("ExpiryTime"), filetime_to_epoch(record.get("ExpiryTime")))
@@ -0,0 +1,162 @@
+import argparse
+import os
+import random
+import sqlite3
+import time
+
+# Builds synthetic wpndatabase.db files with the Windows 10 schema, for benchmarks
+# and for trying the analyzer on cases of a chosen size
+
+SCHEMA = '''
+CREATE TABLE NotificationHandler (RecordId INTEGER PRIMARY KEY AUTOINCREMENT, PrimaryId TEXT NOT NULL UNIQUE,
+    ParentId INTEGER, HandlerType TEXT, WNFEventName INTEGER, SystemDataPropertySet BLOB, WNSId TEXT,
+    CreatedTime INTEGER, ModifiedTime INTEGER);
+CREATE TABLE HandlerAssets (HandlerId INTEGER NOT NULL, AssetKey TEXT NOT NULL, AssetValue TEXT NOT NULL,
+    PRIMARY KEY (HandlerId, AssetKey));
+CREATE TABLE Notification ("Order" INTEGER PRIMARY KEY, Id INTEGER NOT NULL, HandlerId INTEGER NOT NULL,
+    ActivityId BLOB, Type TEXT, Payload BLOB, Tag TEXT, "Group" TEXT, ExpiryTime INTEGER, ArrivalTime INTEGER,
+    DataVersion INTEGER, PayloadType TEXT, BootId INTEGER, ExpiresOnReboot INTEGER);
+'''
+INSERT_HANDLER = 'INSERT INTO NotificationHandler (RecordId, PrimaryId, ParentId, HandlerType, WNFEventName, \
+                    SystemDataPropertySet, WNSId, CreatedTime, ModifiedTime) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+INSERT_ASSET = 'INSERT INTO HandlerAssets (HandlerId, AssetKey, AssetValue) VALUES (?, ?, ?)'
+INSERT_NOTIFICATION = 'INSERT INTO Notification (Id, HandlerId, ActivityId, Type, Payload, Tag, "Group", \
+                    ExpiryTime, ArrivalTime, DataVersion, PayloadType, BootId, ExpiresOnReboot) \
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+DEFAULT_USER_VERSION = 3
+DEFAULT_HANDLERS = 50
+DEFAULT_ASSETS = 3
+DEFAULT_NOTIFICATIONS = 1000
+# Payload sizes follow a log-normal distribution around the median, in bytes
+DEFAULT_PAYLOAD_MEDIAN = 600
+DEFAULT_PAYLOAD_SIGMA = 0.8
+MAX_PAYLOAD_SIZE = 64 * 1024
+INSERT_BATCH_SIZE = 10000
+# 2020-01-01 as a FILETIME, notifications arrive over the following year
+FILETIME_START = 132223104000000000
+FILETIME_SPAN = 365 * 24 * 3600 * 10 ** 7
+FILETIME_DAY = 24 * 3600 * 10 ** 7
+HANDLER_TYPES = ("app:desktop", "app:immersive", "app:system")
+ASSET_KEYS = ("DisplayName", "AppUserModelId", "IconUri", "BackgroundColor", "Publisher", "Version")
+# Share of toast, tile and badge notifications; the rest are raw pushes
+NOTIFICATION_TYPES = (("toast", 0.7), ("tile", 0.15), ("badge", 0.1), ("raw", 0.05))
+WORDS = ("meeting", "message", "photo", "call", "update", "reminder", "download", "shared", "new", "from",
+         "your", "today", "missed", "complete", "calendar", "invite", "file", "alert", "security", "sync")
+
+def generate_db(path, handlers=DEFAULT_HANDLERS, assets=DEFAULT_ASSETS, notifications=DEFAULT_NOTIFICATIONS,
+                payload_median=DEFAULT_PAYLOAD_MEDIAN, payload_sigma=DEFAULT_PAYLOAD_SIGMA,
+                user_version=DEFAULT_USER_VERSION, seed=None):
+    # Writes a new database at path; the same seed always gives the same content
+    if os.path.exists(path):
+        os.remove(path)
+    rng = random.Random(seed)
+    db_conn = sqlite3.connect(path)
+    try:
+        db_conn.executescript(SCHEMA)
+        db_conn.execute('PRAGMA user_version = %d' % int(user_version))
+        with db_conn:
+            db_conn.executemany(INSERT_HANDLER, (new_handler_row(rng, id) for id in range(1, handlers + 1)))
+            db_conn.executemany(INSERT_ASSET, (row for id in range(1, handlers + 1)
+                                               for row in new_asset_rows(rng, id, assets)))
+        rows = []
+        for id in range(1, notifications + 1):
+            rows.append(new_notification_row(rng, id, handlers, payload_median, payload_sigma))
+            if len(rows) == INSERT_BATCH_SIZE:
+                with db_conn:
+                    db_conn.executemany(INSERT_NOTIFICATION, rows)
+                rows = []
+        with db_conn:
+            db_conn.executemany(INSERT_NOTIFICATION, rows)
+    finally:
+        db_conn.close()
+    return path
+
+def new_handler_row(rng, id):
+    created_time = FILETIME_START - rng.randrange(FILETIME_SPAN)
+    return (id, "App%d.Publisher_%08x!App" % (id, rng.getrandbits(32)),
+            rng.randrange(1, id) if id > 1 and rng.random() < 0.1 else None,
+            rng.choice(HANDLER_TYPES),
+            rng.getrandbits(62) if rng.random() < 0.2 else None,
+            random_bytes(rng, 16) if rng.random() < 0.3 else None,
+            "https://wns.windows.com/%032x" % rng.getrandbits(128) if rng.random() < 0.5 else None,
+            created_time, created_time + rng.randrange(FILETIME_SPAN))
+
+def new_asset_rows(rng, id, assets):
+    rows = []
+    for key in ASSET_KEYS[:assets]:
+        if key == "DisplayName":
+            value = "Application %d" % id
+        else:
+            value = "%s-%d-%x" % (key, id, rng.getrandbits(24))
+        rows.append((id, key, value))
+    for index in range(len(ASSET_KEYS), assets):
+        rows.append((id, "Asset%d" % index, "%x" % rng.getrandbits(64)))
+    return rows
+
+def new_notification_row(rng, id, handlers, payload_median, payload_sigma):
+    type = pick_type(rng)
+    size = min(MAX_PAYLOAD_SIZE, int(rng.lognormvariate(0, payload_sigma) * payload_median))
+    arrival_time = FILETIME_START + rng.randrange(FILETIME_SPAN)
+    return (id, rng.randrange(1, handlers + 1), random_bytes(rng, 16),
+            type, new_payload(rng, type, id, size), "tag%d" % (id % 97), "group%d" % (id % 13),
+            arrival_time + rng.randrange(1, 3) * FILETIME_DAY, arrival_time, 1,
+            "raw" if type == "raw" else "xml", rng.getrandbits(16), 0)
+
+def pick_type(rng):
+    value = rng.random()
+    for type, share in NOTIFICATION_TYPES:
+        value -= share
+        if value < 0:
+            return type
+    return NOTIFICATION_TYPES[-1][0]
+
+def new_payload(rng, type, id, size):
+    if type == "raw":
+        return random_bytes(rng, size)
+    if type == "badge":
+        return ('<badge value="%d"/>' % rng.randrange(1, 100)).encode("utf-8")
+    text = new_text(rng, max(size - 200, 10))
+    if type == "tile":
+        return ('<tile><visual><binding template="TileMedium"><text hint-style="caption">%s</text></binding>'
+                '<binding template="TileWide"><image src="ms-appdata:///local/tile%d.png"/><text>%s</text>'
+                '</binding></visual></tile>' % (text, id, text)).encode("utf-8")
+    return ('<toast launch="action=open&amp;id=%d"><visual><binding template="ToastGeneric"><text>%s</text>'
+            '<text>%s</text><image placement="appLogoOverride" src="ms-appdata:///local/logo%d.png"/></binding>'
+            '</visual><actions><action content="Open" arguments="id=%d"/></actions></toast>'
+            % (id, " ".join(rng.choice(WORDS) for i in range(3)), text, id % 50, id)).encode("utf-8")
+
+def random_bytes(rng, size):
+    return rng.getrandbits(size * 8).to_bytes(size, "big") if size else b""
+
+def new_text(rng, size):
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)
+
+def main(args):
+    start_time = time.time()
+    generate_db(args.path, args.handlers, args.assets, args.notifications, args.payload_median,
+                args.payload_sigma, args.user_version, args.seed)
+    total_time = round(time.time() - start_time, 2)
+    print('Generated ' + args.path + ' (' + str(os.path.getsize(args.path)) + ' bytes)')
+    print('Elapsed time: ' + str(total_time) + 's')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Synthetic wpndatabase.db generator')
+    parser.add_argument('-p', '--path', type=str, required=True, help='Path of the database to create')
+    parser.add_argument('-H', '--handlers', type=int, default=DEFAULT_HANDLERS, help='Number of notification handlers')
+    parser.add_argument('-a', '--assets', type=int, default=DEFAULT_ASSETS, help='Number of assets per handler')
+    parser.add_argument('-n', '--notifications', type=int, default=DEFAULT_NOTIFICATIONS, help='Number of notifications')
+    parser.add_argument('-m', '--payload-median', type=int, default=DEFAULT_PAYLOAD_MEDIAN,
+                        help='Median payload size in bytes')
+    parser.add_argument('-g', '--payload-sigma', type=float, default=DEFAULT_PAYLOAD_SIGMA,
+                        help='Spread of the log-normal payload size distribution')
+    parser.add_argument('-u', '--user-version', type=int, default=DEFAULT_USER_VERSION, help='Schema user_version')
+    parser.add_argument('-s', '--seed', type=int, default=None, help='Random seed, for reproducible databases')
+    args = parser.parse_args()
+
+    main(args)
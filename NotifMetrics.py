@@ -0,0 +1,138 @@
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Kept compatible with Python 2 so the Jython ingest module records the same
+# metrics as the parser. A disabled Metrics only costs a method call per phase.
+# ProcessPeakMemory is the high-water mark of the whole process when the phase
+# ends, so it only grows from phase to phase (and from database to database in
+# a --serve worker). The peak of each phase itself, PeakMemory, needs tracemalloc
+# (Python 3.9+), which slows the traced code down and is therefore opt-in
+
+class Metrics(object):
+    # Wall time and process peak memory per phase, and counters, of one database
+    # or of one ingest job
+
+    def __init__(self, name, enabled=True, trace_memory=False):
+        self.name = name
+        self.enabled = enabled
+        self.trace_memory = enabled and trace_memory and tracemalloc is not None and hasattr(tracemalloc, "reset_peak")
+        # Only the Metrics that started tracing stops it, see close
+        self.started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+        self.started = time.time()
+        self.phases = []
+        self.counts = {}
+        self.children = []
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        # Phases are not nested, the peak is reset for each one
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start_time,
+                        tracemalloc.get_traced_memory()[1] if self.trace_memory else None)
+
+    def record(self, name, seconds, peak=None):
+        if self.enabled:
+            phase = {"Phase": name, "Seconds": round(seconds, 4), "ProcessPeakMemory": process_peak_memory()}
+            if peak is not None:
+                phase["PeakMemory"] = peak
+            self.phases.append(phase)
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def add_child(self, child):
+        # Metrics of a sub-task, e.g. each database of an ingest job, or the dict
+        # written by another process
+        if self.enabled and child:
+            self.children.append(child.to_dict() if isinstance(child, Metrics) else child)
+
+    def totals(self):
+        # Seconds per phase name, over this and the child metrics
+        totals = {}
+        for phase in self.phases:
+            totals[phase["Phase"]] = round(totals.get(phase["Phase"], 0) + phase["Seconds"], 4)
+        for child in self.children:
+            for phase in child["Phases"]:
+                totals[phase["Phase"]] = round(totals.get(phase["Phase"], 0) + phase["Seconds"], 4)
+        return totals
+
+    def to_dict(self):
+        return {"Name": self.name, "Started": self.started, "Seconds": round(time.time() - self.started, 4),
+                "Phases": self.phases, "Totals": self.totals(), "Counts": self.counts, "Children": self.children}
+
+    def save(self, path):
+        if not self.enabled:
+            return
+        try:
+            with open(path, 'w') as fp:
+                json.dump(self.to_dict(), fp, indent=4)
+        finally:
+            self.close()
+
+    def close(self):
+        # Stops the tracing started for this database, otherwise every later request
+        # of a --serve worker or batch pool process would stay traced and slow
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+NO_METRICS = Metrics(None, enabled=False)
+
+def process_peak_memory():
+    # Peak resident memory of the process so far in bytes; on Jython, the heap in use
+    if sys.platform.startswith("java"):
+        from java.lang import Runtime
+        runtime = Runtime.getRuntime()
+        return runtime.totalMemory() - runtime.freeMemory()
+    if sys.platform == "win32":
+        return windows_peak_memory()
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def windows_peak_memory():
+    import ctypes
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                    ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                    ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                    ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+    counters = ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    get_current_process = ctypes.windll.kernel32.GetCurrentProcess
+    get_current_process.restype = wintypes.HANDLE
+    get_process_memory_info = ctypes.windll.psapi.GetProcessMemoryInfo
+    get_process_memory_info.argtypes = [wintypes.HANDLE, ctypes.POINTER(ProcessMemoryCounters), wintypes.DWORD]
+    if not get_process_memory_info(get_current_process(), ctypes.byref(counters), counters.cb):
+        return None
+    return counters.PeakWorkingSetSize
+
+def load_metrics(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as fp:
+        return json.load(fp)
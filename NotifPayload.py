@@ -0,0 +1,70 @@
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+from xml.etree.ElementTree import iterparse
+
+# Kept compatible with Python 2 so the Jython ingest module can import it too
+DEFAULT_CACHE_SIZE = 4096
+
+class PayloadCache(object):
+    # Bounded LRU of decoded payloads keyed by the payload hash, since the same
+    # toast and tile payloads repeat across handlers and databases
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def decode(self, payload):
+        if isinstance(payload, type(u"")):
+            payload = payload.encode("utf-8")
+        key = hashlib.sha1(payload).digest()
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                decoded = self.entries.pop(key)
+                self.entries[key] = decoded
+                return decoded
+            self.misses += 1
+        decoded = parse_payload(payload)
+        with self.lock:
+            self.entries[key] = decoded
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return decoded
+
+_cache = PayloadCache()
+
+def decode_payload(payload, cache=None):
+    # The returned dict is shared between identical payloads and must not be modified
+    if not payload:
+        return None
+    return (cache or _cache).decode(payload)
+
+def parse_payload(payload):
+    decoded = {"Kind": None, "Text": [], "Launch": None, "Arguments": [], "Images": [],
+               "TileBindings": [], "Badge": None}
+    try:
+        for event, elem in iterparse(io.BytesIO(payload), events=("start", "end")):
+            tag = elem.tag
+            if event == "start":
+                if decoded["Kind"] is None:
+                    decoded["Kind"] = tag
+                    decoded["Launch"] = elem.get("launch")
+                if tag == "badge":
+                    decoded["Badge"] = elem.get("value")
+                elif tag == "image" and elem.get("src"):
+                    decoded["Images"].append(elem.get("src"))
+                elif tag == "action" and elem.get("arguments"):
+                    decoded["Arguments"].append(elem.get("arguments"))
+                elif tag == "binding" and decoded["Kind"] == "tile":
+                    decoded["TileBindings"].append(elem.get("template"))
+            elif tag == "text" and elem.text:
+                decoded["Text"].append(elem.text)
+    except Exception:
+        # Not XML (e.g. raw or truncated payloads), keep it undecoded
+        return None
+    return decoded
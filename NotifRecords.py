@@ -0,0 +1,148 @@
+import re
+
+# Handlers and notifications as fixed attributes instead of a dict per row,
+# since at millions of notifications the repeated keys outweigh the data
+
+MISSING = object()
+# Bytes that str(bytes) does not write as they are
+BLOB_ESCAPED = re.compile(b"[^\x20-\x7e]|['\\\\]")
+BLOB_ESCAPES = {9: "\\t", 10: "\\n", 13: "\\r", 92: "\\\\"}
+HANDLER_FIELDS = ("HandlerId", "HandlerPrimaryId", "ParentId", "WNSId", "HandlerType", "WNFEventName",
+                  "SystemDataPropertySet", "CreatedTime", "ModifiedTime", "OtherAssets", "Notifications", "AppName",
+                  "Recovered", "RecordType", "FirstSource")
+NOTIFICATION_FIELDS = ("Payload", "Type", "ExpiryTime", "ArrivalTime", "PayloadType", "DecodedPayload", "Recovered",
+                       "RecordType", "HandlerId", "RowId")
+NOTIFICATION_OPTIONAL_FIELDS = NOTIFICATION_FIELDS[5:]
+
+class Record(object):
+    # Item access gives the values as they are serialized, so the code written
+    # for dict records works unchanged; unset fields are missing keys
+    __slots__ = ()
+    fields = frozenset()
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.fields:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        try:
+            delattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.fields and hasattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.fields else default
+
+    def keys(self):
+        return [key for key in self.__slots__ if hasattr(self, key)]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def to_dict(self):
+        result = {}
+        for key in self.__slots__:
+            value = getattr(self, key, MISSING)
+            if value is not MISSING:
+                result[key] = value
+        return result
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+class HandlerRecord(Record):
+    __slots__ = HANDLER_FIELDS
+    fields = frozenset(HANDLER_FIELDS)
+
+    def __init__(self, handler_id, primary_id, parent_id, wns_id, handler_type, wnf_event_name, system_data,
+                 created_time, modified_time):
+        self.HandlerId = handler_id
+        self.HandlerPrimaryId = primary_id
+        self.ParentId = parent_id
+        self.WNSId = wns_id
+        self.HandlerType = handler_type
+        self.WNFEventName = wnf_event_name
+        self.SystemDataPropertySet = system_data
+        self.CreatedTime = created_time
+        self.ModifiedTime = modified_time
+        self.OtherAssets = []
+
+    def to_dict(self):
+        # Notifications are converted with their handler: a default= call per
+        # notification would double the time of the pure Python JSON encoder
+        result = Record.to_dict(self)
+        if "Notifications" in result:
+            result["Notifications"] = [notification.to_dict() if isinstance(notification, Record) else notification
+                                       for notification in self.Notifications]
+        return result
+
+class NotificationRecord(Record):
+    # The payload is kept as read from SQLite and only turned into text when read
+    # as an item, i.e. when serialized
+    __slots__ = NOTIFICATION_FIELDS
+    fields = frozenset(NOTIFICATION_FIELDS)
+
+    def __init__(self, payload, type, expiry_time, arrival_time, payload_type):
+        self.Payload = payload
+        self.Type = type
+        self.ExpiryTime = expiry_time
+        self.ArrivalTime = arrival_time
+        self.PayloadType = payload_type
+
+    def __getitem__(self, key):
+        value = Record.__getitem__(self, key)
+        return str(value) if key == "Payload" else value
+
+    def get(self, key, default=None):
+        if key == "Payload":
+            return str(self.Payload)
+        return Record.get(self, key, default)
+
+    def to_dict(self):
+        result = {"Payload": str(self.Payload), "Type": self.Type, "ExpiryTime": self.ExpiryTime,
+                  "ArrivalTime": self.ArrivalTime, "PayloadType": self.PayloadType}
+        for key in NOTIFICATION_OPTIONAL_FIELDS:
+            value = getattr(self, key, MISSING)
+            if value is not MISSING:
+                result[key] = value
+        return result
+
+def to_json(value):
+    # default= hook of json.dump; each record becomes a dict only while it is written
+    if isinstance(value, Record):
+        return value.to_dict()
+    raise TypeError("Object of type " + type(value).__name__ + " is not JSON serializable")
+
+def blob_text(data):
+    # The text str() gives a BLOB on Python 3, which is how the parser writes
+    # payloads; lets the Jython JDBC reader produce the very same values
+    data = bytes(data)
+    if not BLOB_ESCAPED.search(data):
+        return "b'" + data.decode("ascii") + "'"
+    array = bytearray(data)
+    quote = 34 if 39 in array and 34 not in array else 39
+    parts = []
+    for value in array:
+        if value == quote:
+            parts.append("\\" + chr(value))
+        elif value in BLOB_ESCAPES:
+            parts.append(BLOB_ESCAPES[value])
+        elif value < 32 or value > 126:
+            parts.append("\\x%02x" % value)
+        else:
+            parts.append(chr(value))
+    return "b" + chr(quote) + "".join(parts) + chr(quote)
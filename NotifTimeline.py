@@ -0,0 +1,261 @@
+import argparse
+import bisect
+import calendar
+import hashlib
+import json
+import numbers
+import os
+import sys
+import time
+from array import array
+from datetime import datetime
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Kept compatible with Python 2 so the Jython ingest module can decode timestamps
+# in bulk too. Merges the notifications of any number of databases (users,
+# snapshots) into one timeline sorted by arrival
+
+FILETIME_EPOCH_OFFSET = 116444736000000000
+FILETIME_TICKS_PER_SECOND = 10000000
+# Below this many values the conversion to and from numpy arrays costs more than it saves
+NUMPY_MIN_SIZE = 256
+TIME_COLUMNS = (("ArrivalTime", "ArrivalEpoch"), ("ExpiryTime", "ExpiryEpoch"))
+SQLITE_HEADER = b"SQLite format 3\x00"
+BATCH_INDEX = "index.json"
+DEFAULT_MIN_GAP = 3600
+DEFAULT_BIN_SIZE = 3600
+# 64 bit integers; Python 2 only has 'l', which is 64 bit on Jython and on Linux
+ARRAY_TYPECODE = 'q' if 'q' in getattr(array, 'typecodes', '') else 'l'
+
+def decode_filetimes(filetimes):
+    # Epoch seconds of each FILETIME, None where missing or zero
+    values = [value if isinstance(value, numbers.Integral) and value > 0 else 0 for value in filetimes]
+    if numpy is not None and len(values) >= NUMPY_MIN_SIZE:
+        raw = numpy.array(values, dtype=numpy.int64)
+        epochs = ((raw - FILETIME_EPOCH_OFFSET) // FILETIME_TICKS_PER_SECOND).tolist()
+    else:
+        raw = array(ARRAY_TYPECODE, values)
+        epochs = [(value - FILETIME_EPOCH_OFFSET) // FILETIME_TICKS_PER_SECOND for value in raw]
+    return [epoch if value else None for value, epoch in zip(values, epochs)]
+
+def filetime_to_epoch(filetime):
+    if not isinstance(filetime, numbers.Integral) or filetime <= 0:
+        return None
+    return (filetime - FILETIME_EPOCH_OFFSET) // FILETIME_TICKS_PER_SECOND
+
+def decode_notification_times(notifications):
+    # Adds ArrivalEpoch and ExpiryEpoch to the notifications that do not have them yet
+    pending = [notification for notification in notifications if "ArrivalEpoch" not in notification]
+    for column, epoch_column in TIME_COLUMNS:
+        for notification, epoch in zip(pending, decode_filetimes([notification.get(column) for notification in pending])):
+            notification[epoch_column] = epoch
+    return notifications
+
+def notification_id(handler, notification):
+    # Same notification in several snapshots of a database, whatever its row id
+    parts = (handler.get("HandlerPrimaryId"), notification.get("ArrivalTime"), notification.get("Type"),
+             notification.get("Payload"))
+    return hashlib.sha1(u"\x00".join(u"%s" % (part,) for part in parts).encode("utf-8")).hexdigest()
+
+class Timeline(object):
+    # Notifications merged by identity, each decoded once and tagged with every
+    # source it was found in; arrivals are kept sorted for range queries
+
+    def __init__(self):
+        self.sources = []
+        self.entries = []
+        self.positions = {}
+        self.arrivals = None
+        self.ordered = None
+
+    def add_source(self, source, records):
+        # records are (handler, notification) pairs; returns the number of new entries
+        if source in self.sources:
+            return 0
+        self.sources.append(source)
+        source_index = len(self.sources) - 1
+        added = []
+        for handler, notification in records:
+            key = notification_id(handler, notification)
+            position = self.positions.get(key)
+            if position is None:
+                entry = {"Id": key, "AppName": handler.get("AppName"), "HandlerPrimaryId": handler.get("HandlerPrimaryId"),
+                         "Type": notification.get("Type"), "ArrivalTime": notification.get("ArrivalTime"),
+                         "ExpiryTime": notification.get("ExpiryTime"), "Recovered": bool(notification.get("Recovered")),
+                         "Sources": []}
+                self.positions[key] = len(self.entries)
+                self.entries.append(entry)
+                added.append(entry)
+            else:
+                entry = self.entries[position]
+            if source_index not in entry["Sources"]:
+                entry["Sources"].append(source_index)
+        decode_notification_times(added)
+        self.arrivals = None
+        return len(added)
+
+    def index(self):
+        if self.arrivals is None:
+            self.ordered = sorted((entry for entry in self.entries if entry["ArrivalEpoch"] is not None),
+                                  key=lambda entry: entry["ArrivalEpoch"])
+            self.arrivals = array(ARRAY_TYPECODE, [entry["ArrivalEpoch"] for entry in self.ordered])
+        return self.arrivals
+
+    def range(self, start=None, end=None, app_name=None):
+        # Entries arrived in [start, end), by arrival
+        arrivals = self.index()
+        first = 0 if start is None else bisect.bisect_left(arrivals, start)
+        last = len(arrivals) if end is None else bisect.bisect_left(arrivals, end)
+        return [entry for entry in self.ordered[first:last] if app_name is None or entry["AppName"] == app_name]
+
+    def gaps(self, min_gap=DEFAULT_MIN_GAP, start=None, end=None):
+        # Periods of at least min_gap seconds without any arrival, e.g. the device was off
+        entries = self.range(start, end)
+        arrivals = [entry["ArrivalEpoch"] for entry in entries]
+        if numpy is not None and len(arrivals) >= NUMPY_MIN_SIZE:
+            positions = numpy.nonzero(numpy.diff(numpy.array(arrivals, dtype=numpy.int64)) >= min_gap)[0].tolist()
+        else:
+            positions = [i for i in range(len(arrivals) - 1) if arrivals[i + 1] - arrivals[i] >= min_gap]
+        return [{"Start": arrivals[i], "End": arrivals[i + 1], "Seconds": arrivals[i + 1] - arrivals[i],
+                 "Before": entries[i]["Id"], "After": entries[i + 1]["Id"]} for i in positions]
+
+    def activity(self, bin_size=DEFAULT_BIN_SIZE, start=None, end=None, app_name=None):
+        # {app name: {bin start: notifications}}
+        bins = {}
+        for entry in self.range(start, end, app_name):
+            app_bins = bins.setdefault(entry["AppName"] or entry["HandlerPrimaryId"] or "UNKNOWN", {})
+            bin_start = entry["ArrivalEpoch"] - entry["ArrivalEpoch"] % bin_size
+            app_bins[bin_start] = app_bins.get(bin_start, 0) + 1
+        return bins
+
+    def save(self, path):
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w') as fp:
+            json.dump({"Sources": self.sources, "Entries": self.entries}, fp)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        timeline = cls()
+        if os.path.exists(path):
+            with open(path) as fp:
+                data = json.load(fp)
+            timeline.sources = data["Sources"]
+            timeline.entries = data["Entries"]
+            timeline.positions = dict((entry["Id"], position) for position, entry in enumerate(timeline.entries))
+        return timeline
+
+def source_records(path):
+    # Yields (handler, notification) from a NotifAnalyzer JSON or NDJSON result or
+    # from a wpndatabase.db itself
+    with open(path, 'rb') as fp:
+        header = fp.read(len(SQLITE_HEADER))
+    if header == SQLITE_HEADER:
+        from NotifAnalyzer import stream_db
+        records = stream_db(path)
+    elif path.endswith(".ndjson"):
+        records = ndjson_records(path)
+    else:
+        with open(path) as fp:
+            data = json.load(fp)
+        for handler in data["assets"].values():
+            for notification in handler["Notifications"]:
+                yield handler, notification
+        return
+    handlers = {}
+    for record in records:
+        if record.get("RecordType") == "handler":
+            handlers[record["HandlerId"]] = record
+        elif record.get("RecordType") == "notification":
+            yield handlers.get(record["HandlerId"], {}), record
+
+def ndjson_records(path):
+    with open(path) as fp:
+        for line in fp:
+            if line.strip():
+                yield json.loads(line)
+
+def find_sources(paths):
+    # Batch output directories are read through their index
+    sources = []
+    for path in paths:
+        batch_index = os.path.join(path, BATCH_INDEX)
+        if os.path.isdir(path) and os.path.exists(batch_index):
+            with open(batch_index) as fp:
+                sources.extend(entry["result"] for entry in json.load(fp)
+                               if entry["status"] == "ok" and entry["result"] and not os.path.isdir(entry["result"])
+                               and not entry["result"].endswith(".db"))
+        else:
+            sources.append(path)
+    return sources
+
+def parse_time(value):
+    # Epoch seconds or a UTC date like 2020-05-01T14:00:00
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    for time_format in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+        try:
+            return calendar.timegm(datetime.strptime(value, time_format).timetuple())
+        except ValueError:
+            pass
+    raise ValueError("Invalid time: " + value)
+
+def main(args):
+    start_time = time.time()
+    timeline = Timeline.load(args.index)
+    if args.command == "build":
+        for source in find_sources(args.sources):
+            added = timeline.add_source(os.path.abspath(source), source_records(source))
+            print(source + ": " + str(added) + " new notifications")
+        timeline.save(args.index)
+        print("Timeline: " + str(len(timeline.entries)) + " notifications from " + str(len(timeline.sources)) + " sources")
+    else:
+        start = parse_time(args.start)
+        end = parse_time(args.end)
+        if args.command == "range":
+            result = [dict(entry, Sources=[timeline.sources[source] for source in entry["Sources"]])
+                      for entry in timeline.range(start, end, args.app)]
+        elif args.command == "gaps":
+            result = timeline.gaps(args.min_gap, start, end)
+        else:
+            result = timeline.activity(args.bin, start, end, args.app)
+        json.dump(result, sys.stdout, indent=4)
+        print("")
+    sys.stderr.write('Elapsed time: ' + str(round(time.time() - start_time, 2)) + 's\n')
+
+def setup_args():
+    parser = argparse.ArgumentParser(description='Merged notification timeline of several databases')
+    parser.add_argument('-i', '--index', type=str, required=True, help='Path to the timeline index (JSON)')
+    commands = parser.add_subparsers(dest='command')
+    build = commands.add_parser('build', help='Add databases, JSON/NDJSON results or batch output directories')
+    build.add_argument('sources', nargs='+')
+    for name, help in (('range', 'Notifications arrived in a time range'),
+                       ('gaps', 'Periods without any notification'),
+                       ('activity', 'Notifications per app and time bin')):
+        command = commands.add_parser(name, help=help)
+        command.add_argument('--start', type=str, default=None, help='Epoch seconds or UTC date (inclusive)')
+        command.add_argument('--end', type=str, default=None, help='Epoch seconds or UTC date (exclusive)')
+        if name == 'gaps':
+            command.add_argument('--min-gap', type=int, default=DEFAULT_MIN_GAP, help='Shortest gap in seconds')
+        else:
+            command.add_argument('--app', type=str, default=None, help='Only this app name')
+        if name == 'activity':
+            command.add_argument('--bin', type=int, default=DEFAULT_BIN_SIZE, help='Bin size in seconds')
+    args = parser.parse_args()
+    if not args.command:
+        parser.error("A command is required")
+    return args
+
+if __name__ == "__main__":
+    args = setup_args()
+    main(args)
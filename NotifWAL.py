@@ -0,0 +1,216 @@
+import bisect
+import mmap
+import os
+import struct
+from NotifCarver import read_header, read_schemas, read_varint, column_layout, parse_record, TABLE_LEAF_PAGE, HEADER_SIZE
+
+# Reads every version of the Notification and NotificationHandler rows kept in
+# the frames of wpndatabase.db-wal, without checkpointing or copying the WAL
+
+WAL_SUFFIX = "-wal"
+WAL_HEADER_SIZE = 32
+FRAME_HEADER_SIZE = 24
+WAL_MAGIC_LE = 0x377f0682
+WAL_MAGIC_BE = 0x377f0683
+# Latest committed version of a row
+CURRENT = "current"
+# Older committed version, replaced by a later commit
+SUPERSEDED = "superseded"
+# Written after the last commit, e.g. an interrupted transaction
+UNCOMMITTED = "uncommitted"
+# Last committed version is gone from the final image of its page
+DELETED = "deleted"
+# Left over from before the last checkpoint restarted the WAL (different salt)
+PREVIOUS_CHECKPOINT = "previous-checkpoint"
+
+def read_wal(file):
+    # Returns the WAL summary and the per-row version history, or None without a WAL
+    wal_path = file + WAL_SUFFIX
+    if not os.path.exists(wal_path) or os.path.getsize(wal_path) < WAL_HEADER_SIZE:
+        return None
+    schemas = read_schemas(file)
+    layouts = dict((table, column_layout(columns)) for table, columns in schemas.items())
+    with open(file, 'rb') as fp:
+        db_header = fp.read(HEADER_SIZE)
+    encoding = read_header(db_header)[1]
+    reserved = db_header[20] if len(db_header) > 20 else 0
+    with open(wal_path, 'rb') as fp, open(file, 'rb') as db:
+        wal = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            frames, page_size, salt = index_frames(wal)
+            # Frame numbers of each page per WAL generation, in log order
+            index = {}
+            for frame in frames:
+                index.setdefault(frame["Salt"], {}).setdefault(frame["Page"], []).append(frame["Frame"])
+            ends = transaction_ends(frames)
+            reader = PageReader(db, wal, index, page_size)
+            history = {}
+            for frame in frames:
+                page = read_frame_page(wal, frame["Frame"], page_size)
+                reader.view(frame["Salt"], ends[frame["Frame"]])
+                for table, rowid, record in read_page_records(page, frame["Page"], page_size - reserved,
+                                                              reader, layouts, encoding):
+                    versions = history.setdefault((table, rowid), [])
+                    # Pages are rewritten whole, most rows are unchanged from the previous frame
+                    if versions and versions[-1]["Record"] == record and versions[-1]["Salt"] == frame["Salt"] \
+                            and versions[-1]["State"] == frame["State"]:
+                        versions[-1]["Page"] = frame["Page"]
+                        versions[-1]["LastSeenFrame"] = frame["Frame"]
+                        continue
+                    versions.append({"Frame": frame["Frame"], "LastSeenFrame": frame["Frame"], "Page": frame["Page"],
+                                     "Salt": frame["Salt"], "State": frame["State"], "Record": record})
+        finally:
+            wal.close()
+    last_commits = {}
+    for frame in frames:
+        if frame["State"] == CURRENT:
+            last_commits[frame["Page"]] = frame["Frame"]
+    for versions in history.values():
+        mark_current(versions, last_commits)
+    return {
+        "PageSize": page_size,
+        "Salt": salt,
+        "Frames": len(frames),
+        "Index": dict((frame_salt, dict((str(page), frame_ids) for page, frame_ids in salt_pages.items()))
+                      for frame_salt, salt_pages in index.items()),
+        "History": [{"Table": table, "RowId": rowid, "Versions": versions}
+                    for (table, rowid), versions in sorted(history.items(), key=lambda item: (item[0][0], item[0][1]))]
+    }
+
+def index_frames(wal):
+    magic, version, page_size, checkpoint, salt1, salt2 = struct.unpack(">IIIIII", wal[0:24])
+    if magic not in (WAL_MAGIC_LE, WAL_MAGIC_BE):
+        raise ValueError("Not a SQLite WAL file")
+    big_endian = magic == WAL_MAGIC_BE
+    checksum = wal_checksum(wal[0:24], (0, 0), big_endian)
+    if checksum != struct.unpack(">II", wal[24:32]):
+        raise ValueError("Corrupt WAL header")
+    salt = "%08x-%08x" % (salt1, salt2)
+    frames = []
+    last_commit = -1
+    valid = True
+    frame_size = FRAME_HEADER_SIZE + page_size
+    for number, offset in enumerate(range(WAL_HEADER_SIZE, len(wal) - frame_size + 1, frame_size)):
+        page, db_size, frame_salt1, frame_salt2, checksum1, checksum2 = struct.unpack(">IIIIII", wal[offset:offset + 24])
+        frame = {"Frame": number, "Page": page, "Salt": "%08x-%08x" % (frame_salt1, frame_salt2),
+                 "Commit": db_size != 0, "State": None}
+        if valid and (frame_salt1, frame_salt2) == (salt1, salt2):
+            # Each frame checksum chains from the previous one, the first break ends the valid log
+            checksum = wal_checksum(wal[offset:offset + 8], checksum, big_endian)
+            checksum = wal_checksum(wal[offset + FRAME_HEADER_SIZE:offset + frame_size], checksum, big_endian)
+            valid = checksum == (checksum1, checksum2)
+        else:
+            valid = False
+        frame["Valid"] = valid
+        if valid and db_size:
+            last_commit = number
+        frames.append(frame)
+    for frame in frames:
+        if frame["Valid"]:
+            frame["State"] = CURRENT if frame["Frame"] <= last_commit else UNCOMMITTED
+        else:
+            frame["State"] = PREVIOUS_CHECKPOINT
+    return frames, page_size, salt
+
+def wal_checksum(data, seed, big_endian):
+    s0, s1 = seed
+    words = struct.unpack((">" if big_endian else "<") + "I" * (len(data) // 4), data)
+    for i in range(0, len(words), 2):
+        s0 = (s0 + words[i] + s1) & 0xffffffff
+        s1 = (s1 + words[i + 1] + s0) & 0xffffffff
+    return s0, s1
+
+def read_frame_page(wal, number, page_size):
+    offset = WAL_HEADER_SIZE + number * (FRAME_HEADER_SIZE + page_size) + FRAME_HEADER_SIZE
+    return wal[offset:offset + page_size]
+
+def transaction_ends(frames):
+    # Last frame of the transaction of each frame: its commit frame, or the end of the log
+    ends = [len(frames) - 1] * len(frames)
+    end = len(frames) - 1
+    for frame in reversed(frames):
+        if frame["Commit"]:
+            end = frame["Frame"]
+        ends[frame["Frame"]] = end
+    return ends
+
+class PageReader(object):
+    # Gives the content of a page as seen by the transaction of a frame: its latest
+    # frame of the same WAL generation up to the commit, else the database file
+
+    def __init__(self, db, wal, index, page_size):
+        self.db = db
+        self.wal = wal
+        self.index = index
+        self.page_size = page_size
+        self.pages = {}
+        self.end = None
+
+    def view(self, salt, end):
+        self.pages = self.index.get(salt, {})
+        self.end = end
+
+    def read(self, page):
+        frame_ids = self.pages.get(page)
+        if frame_ids:
+            position = bisect.bisect_right(frame_ids, self.end)
+            if position:
+                return read_frame_page(self.wal, frame_ids[position - 1], self.page_size)
+        self.db.seek((page - 1) * self.page_size)
+        return self.db.read(self.page_size)
+
+def read_page_records(page, page_number, usable_size, pages, layouts, encoding):
+    header = HEADER_SIZE if page_number == 1 else 0
+    if len(page) <= header or page[header] != TABLE_LEAF_PAGE:
+        return
+    num_cells = struct.unpack(">H", page[header + 3:header + 5])[0]
+    for i in range(num_cells):
+        pointer = header + 8 + i * 2
+        cell = struct.unpack(">H", page[pointer:pointer + 2])[0]
+        if cell >= len(page):
+            continue
+        payload_size, position = read_varint(page, cell)
+        rowid, position = read_varint(page, position)
+        payload = read_payload(page, position, payload_size, usable_size, pages)
+        if payload is None:
+            continue
+        for table, layout in layouts.items():
+            match = parse_record(payload, 0, len(payload), layout, encoding)
+            if match:
+                yield table, rowid, match[0]
+                break
+
+def read_payload(page, position, payload_size, usable_size, pages):
+    # Cell payload size rules of the SQLite file format for table leaf pages
+    max_local = usable_size - 35
+    if payload_size <= max_local:
+        return page[position:position + payload_size]
+    min_local = (usable_size - 12) * 32 // 255 - 23
+    local = min_local + (payload_size - min_local) % (usable_size - 4)
+    if local > max_local:
+        local = min_local
+    payload = [page[position:position + local]]
+    remaining = payload_size - local
+    overflow = struct.unpack(">I", page[position + local:position + local + 4])[0]
+    seen = set()
+    while remaining > 0 and overflow and overflow not in seen:
+        seen.add(overflow)
+        content = pages.read(overflow)
+        if len(content) < 4:
+            return None
+        chunk = content[4:4 + min(remaining, usable_size - 4)]
+        payload.append(chunk)
+        remaining -= len(chunk)
+        overflow = struct.unpack(">I", content[0:4])[0]
+    if remaining > 0:
+        return None
+    return b"".join(payload)
+
+def mark_current(versions, last_commits):
+    # Only the last committed version of the current WAL generation is current,
+    # and only while the last committed image of its page still holds it
+    committed = [version for version in versions if version["State"] == CURRENT]
+    for version in committed[:-1]:
+        version["State"] = SUPERSEDED
+    if committed and last_commits.get(committed[-1]["Page"]) != committed[-1]["LastSeenFrame"]:
+        committed[-1]["State"] = DELETED
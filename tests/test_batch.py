@@ -0,0 +1,70 @@
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import NotifAnalyzer
+from NotifAnalyzer import FORMAT_JSON, find_databases, run_batch
+from NotifGenerator import generate_db
+
+CRASHING = "u3"
+process_batch_file = NotifAnalyzer.process_batch_file
+
+def crashing_batch_file(file, *args):
+    # Stands for a worker killed while reading a database, e.g. inside SQLite
+    if CRASHING + os.sep in file:
+        os._exit(1)
+    return process_batch_file(file, *args)
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cases = os.path.join(self.directory, "cases")
+        for number in range(10):
+            os.makedirs(os.path.join(self.cases, "u" + str(number)))
+            generate_db(os.path.join(self.cases, "u" + str(number), "wpndatabase.db"), handlers=3, notifications=20,
+                        seed=number)
+        self.output = os.path.join(self.directory, "out")
+
+    def tearDown(self):
+        NotifAnalyzer.process_batch_file = process_batch_file
+        shutil.rmtree(self.directory)
+
+    def statuses(self, index):
+        return dict((os.path.basename(os.path.dirname(entry["path"])), entry["status"]) for entry in index)
+
+    def test_all_databases(self):
+        index = run_batch(self.cases, self.output, FORMAT_JSON, 2)
+        self.assertEqual(set(self.statuses(index).values()), {"ok"})
+        self.assertEqual(len(index), 10)
+
+    @unittest.skipUnless(multiprocessing.get_start_method() == "fork", "the workers must inherit the patched function")
+    def test_crashed_worker_fails_only_its_database(self):
+        NotifAnalyzer.process_batch_file = crashing_batch_file
+        statuses = self.statuses(run_batch(self.cases, self.output, FORMAT_JSON, 2))
+        self.assertEqual(len(statuses), 10)
+        self.assertEqual(statuses.pop(CRASHING), "error")
+        self.assertEqual(set(statuses.values()), {"ok"})
+
+    def test_corrupt_database_is_not_a_manifest(self):
+        path = os.path.join(self.cases, "u0", "wpndatabase.db")
+        with open(path, 'w') as fp:
+            fp.write("u1/wpndatabase.db\n")
+        self.assertEqual(find_databases(path), [path])
+        statuses = self.statuses(run_batch(path, self.output, FORMAT_JSON, 1))
+        self.assertEqual(statuses, {"u0": "error"})
+
+    def test_manifest_entries_are_relative_to_the_manifest(self):
+        manifest = os.path.join(self.cases, "manifest.txt")
+        with open(manifest, 'w') as fp:
+            fp.write("# two cases\nu1/wpndatabase.db\n" + os.path.join(self.cases, "u2", "wpndatabase.db") + "\n")
+        self.assertEqual(find_databases(manifest), [os.path.join(self.cases, "u1", "wpndatabase.db"),
+                                                    os.path.join(self.cases, "u2", "wpndatabase.db")])
+
+if __name__ == "__main__":
+    unittest.main()
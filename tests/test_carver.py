@@ -0,0 +1,85 @@
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from NotifAnalyzer import ASSETS, RECOVERED, read_db
+from NotifCarver import carve_db
+from NotifGenerator import generate_db
+
+# Share of the deleted notifications the carver must find. Records overwritten by
+# a freeblock header or by the cell pointer array growing are lost for good
+MIN_RECOVERED = 0.6
+
+class CarverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = generate_db(os.path.join(self.directory, "wpndatabase.db"), handlers=10, notifications=1000,
+                                seed=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def delete(self, secure_delete):
+        # Python's SQLite is built with secure_delete on, which zeroes deleted content.
+        # Returns the deleted rows by Id
+        conn = sqlite3.connect(self.path)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute('PRAGMA secure_delete = %s' % ("ON" if secure_delete else "OFF"))
+            rows = conn.execute('SELECT * FROM Notification WHERE "Order" % 3 = 0')
+            deleted = dict((row["Id"], dict(row)) for row in rows)
+            with conn:
+                conn.execute('DELETE FROM Notification WHERE "Order" % 3 = 0')
+        finally:
+            conn.close()
+        return deleted
+
+    def test_carves_deleted_notifications(self):
+        deleted = self.delete(secure_delete=False)
+        carved = carve_db(self.path, workers=1)
+        found = set(deleted).intersection(record["Id"] for record in carved["Notification"])
+        self.assertGreater(len(found), len(deleted) * MIN_RECOVERED)
+
+    def test_carved_records_match_deleted_rows(self):
+        deleted = self.delete(secure_delete=False)
+        for record in carve_db(self.path, workers=1)["Notification"]:
+            if record["Id"] not in deleted:
+                continue
+            row = deleted[record["Id"]]
+            # Columns lost to a freeblock header are None, the others are as written
+            for column, value in row.items():
+                if record.get(column) is not None:
+                    self.assertEqual(record[column], value, column)
+
+    def test_workers_give_the_same_records(self):
+        self.delete(secure_delete=False)
+        key = lambda record: (record["Page"], record["Offset"])
+        self.assertEqual(sorted(carve_db(self.path, workers=1)["Notification"], key=key),
+                         sorted(carve_db(self.path, workers=2)["Notification"], key=key))
+
+    def test_secure_delete_leaves_nothing(self):
+        deleted = self.delete(secure_delete=True)
+        carved = carve_db(self.path, workers=1)
+        found = set(deleted).intersection(record["Id"] for record in carved["Notification"])
+        self.assertLess(len(found), len(deleted) * (1 - MIN_RECOVERED))
+
+    def test_recover_merges_deleted_notifications(self):
+        deleted = self.delete(secure_delete=False)
+        db_info = read_db(self.path, recover=True, workers=1)
+        notifications = [(handler["HandlerId"], notification) for handler in db_info[ASSETS].values()
+                         for notification in handler["Notifications"]]
+        recovered = set((handler_id, notification["Type"], notification["ArrivalTime"])
+                        for handler_id, notification in notifications if notification.get(RECOVERED))
+        found = recovered.intersection((row["HandlerId"], row["Type"], row["ArrivalTime"]) for row in deleted.values())
+        self.assertGreater(len(found), len(deleted) * MIN_RECOVERED)
+        self.assertEqual(sum(1 for handler_id, notification in notifications if not notification.get(RECOVERED)),
+                         1000 - len(deleted))
+
+if __name__ == "__main__":
+    unittest.main()
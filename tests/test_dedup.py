@@ -0,0 +1,145 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from NotifDedup import DUPLICATE, FIRST_SOURCE, KIND_HANDLER, KIND_NOTIFICATION, DedupIndex, dedup_assets, \
+    dedup_records, handler_key
+from NotifTimeline import notification_id
+
+FIRST = "/case/first/wpndatabase.db"
+SECOND = "/case/second/wpndatabase.db"
+THIRD = "/case/third/wpndatabase.db"
+
+def handler(id, primary_id, *notifications):
+    return {"HandlerId": id, "HandlerPrimaryId": primary_id, "HandlerType": "app:desktop", "CreatedTime": 1000 + id,
+            "ModifiedTime": 2000 + id, "Notifications": [notification(arrival) for arrival in notifications]}
+
+def notification(arrival):
+    return {"Payload": "b'<toast>" + str(arrival) + "</toast>'", "Type": "toast", "ArrivalTime": arrival,
+            "ExpiryTime": arrival + 10, "PayloadType": "xml"}
+
+def assets(*handlers):
+    return dict((handler["HandlerId"], handler) for handler in handlers)
+
+def records(*handlers):
+    # The records of NotifAnalyzer.stream_db: every handler, then every notification
+    result = [{"RecordType": "database", "user_version": 3}]
+    for dict_asset in handlers:
+        record = dict((key, value) for key, value in dict_asset.items() if key != "Notifications")
+        record["RecordType"] = KIND_HANDLER
+        result.append(record)
+    for dict_asset in handlers:
+        for notif in dict_asset["Notifications"]:
+            record = dict(notif)
+            record["RecordType"] = KIND_NOTIFICATION
+            record["HandlerId"] = dict_asset["HandlerId"]
+            result.append(record)
+    return result
+
+class DedupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "dedup.db")
+        self.index = DedupIndex(self.path)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.directory)
+
+    def test_first_source_wins(self):
+        keys = [("a", KIND_NOTIFICATION), ("b", KIND_NOTIFICATION)]
+        self.assertEqual(self.index.add(FIRST, keys), {})
+        self.assertEqual(self.index.add(SECOND, keys + [("c", KIND_NOTIFICATION)]), {"a": FIRST, "b": FIRST})
+        self.assertEqual(self.index.add(THIRD, [("c", KIND_NOTIFICATION)]), {"c": SECOND})
+        self.assertEqual(self.index.duplicates, {KIND_HANDLER: 0, KIND_NOTIFICATION: 3})
+        self.assertEqual(self.index.sources(["a", "c", "d"]), {"a": [FIRST, SECOND], "c": [SECOND, THIRD], "d": []})
+
+    def test_same_source_again_has_no_duplicates(self):
+        keys = [("a", KIND_NOTIFICATION), ("a", KIND_NOTIFICATION)]
+        self.assertEqual(self.index.add(FIRST, keys), {})
+        self.assertEqual(self.index.add(FIRST, keys), {})
+        self.assertEqual(self.index.links(), [])
+
+    def test_processes_sharing_the_index(self):
+        # Another process has its own connection and source cache
+        other = DedupIndex(self.path)
+        try:
+            self.assertEqual(other.add(SECOND, [("a", KIND_NOTIFICATION)]), {})
+            self.assertEqual(self.index.add(FIRST, [("a", KIND_NOTIFICATION), ("b", KIND_NOTIFICATION)]),
+                             {"a": SECOND})
+            self.assertEqual(other.add(SECOND, [("b", KIND_NOTIFICATION)]), {"b": FIRST})
+        finally:
+            other.close()
+        links = dict((link["Id"], link) for link in self.index.links())
+        self.assertEqual(links["a"][FIRST_SOURCE], SECOND)
+        # The first source first, although it was registered after the other
+        self.assertEqual(links["a"]["Sources"], [SECOND, FIRST])
+        self.assertEqual(links["b"]["Sources"], [FIRST, SECOND])
+        self.assertEqual([link["Id"] for link in self.index.links(key="b")], ["b"])
+
+    def test_handler_key(self):
+        self.assertEqual(handler_key(handler(1, "App!1")), handler_key(dict(handler(7, "App!1"), CreatedTime=1001)))
+        self.assertNotEqual(handler_key(handler(1, "App!1")), handler_key(handler(1, "App!2")))
+        self.assertIsNone(handler_key(handler(1, None)))
+
+    def test_assets_of_the_same_database_again(self):
+        self.assertEqual(dedup_assets(self.index, FIRST, assets(handler(1, "App!1", 10, 11))), [])
+        second = assets(handler(1, "App!1", 10, 11))
+        links = dedup_assets(self.index, SECOND, second)
+        self.assertEqual(second, {})
+        self.assertEqual(sorted((link["Kind"], link["HandlerId"], link[FIRST_SOURCE], tuple(link["Sources"]))
+                                for link in links),
+                         [(KIND_HANDLER, 1, FIRST, (FIRST, SECOND))] +
+                         [(KIND_NOTIFICATION, 1, FIRST, (FIRST, SECOND))] * 2)
+
+    def test_handler_with_a_new_notification_is_kept(self):
+        dedup_assets(self.index, FIRST, assets(handler(1, "App!1", 10)))
+        second = assets(handler(1, "App!1", 10, 12))
+        links = dedup_assets(self.index, SECOND, second)
+        self.assertEqual([notif["ArrivalTime"] for notif in second[1]["Notifications"]], [12])
+        self.assertEqual(second[1][FIRST_SOURCE], FIRST)
+        self.assertEqual([link["Kind"] for link in links], [KIND_NOTIFICATION])
+
+    def test_placeholder_handlers(self):
+        # Handlers of recovered notifications have no primary id, so no identity of their own
+        dedup_assets(self.index, FIRST, assets(handler(1, None, 10), handler(2, None, 20)))
+        second = assets(handler(1, None, 10), handler(2, None, 20, 21), handler(3, None))
+        links = dedup_assets(self.index, SECOND, second)
+        # Emptied by the dedup, kept with its new notification, and empty from the start
+        self.assertEqual(sorted(second), [2, 3])
+        self.assertEqual([notif["ArrivalTime"] for notif in second[2]["Notifications"]], [21])
+        self.assertNotIn(FIRST_SOURCE, second[2])
+        self.assertEqual(sorted(link["Kind"] for link in links), [KIND_NOTIFICATION] * 2)
+
+    def test_records_hold_duplicate_handlers_back(self):
+        list(dedup_records(self.index, FIRST, records(handler(1, "App!1", 10), handler(2, "App!2", 20))))
+        stream = records(handler(1, "App!1", 10, 12), handler(2, "App!2", 20))
+        # A batch per record, so the handlers are decided before their notifications are seen
+        kept = list(dedup_records(self.index, SECOND, stream, batch_size=1))
+        types = [(record["RecordType"], record.get("Kind"), record.get("HandlerId")) for record in kept]
+        self.assertEqual(types, [("database", None, None),
+                                 (DUPLICATE, KIND_NOTIFICATION, 1),
+                                 # Held back until its new notification, which follows it
+                                 (KIND_HANDLER, None, 1), (KIND_NOTIFICATION, None, 1),
+                                 (DUPLICATE, KIND_NOTIFICATION, 2),
+                                 # Never got a new notification, only its link is left
+                                 (DUPLICATE, KIND_HANDLER, 2)])
+        self.assertEqual(kept[2][FIRST_SOURCE], FIRST)
+        self.assertEqual(kept[3]["ArrivalTime"], 12)
+        self.assertEqual(kept[-1]["Sources"], [FIRST, SECOND])
+
+    def test_records_and_assets_share_keys(self):
+        first = handler(1, "App!1", 10)
+        dedup_assets(self.index, FIRST, assets(first))
+        kept = list(dedup_records(self.index, SECOND, records(handler(1, "App!1", 10))))
+        self.assertEqual([record["RecordType"] for record in kept], ["database", DUPLICATE, DUPLICATE])
+        self.assertEqual(set(record["Id"] for record in kept[1:]),
+                         {handler_key(first), notification_id(first, first["Notifications"][0])})
+
+if __name__ == "__main__":
+    unittest.main()
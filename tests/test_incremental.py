@@ -0,0 +1,100 @@
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from NotifAnalyzer import ASSETS, DELTA, FINGERPRINT_RANGE, FINGERPRINTS, FORMAT_JSON, FORMAT_NDJSON, \
+    run_incremental
+from NotifGenerator import generate_db
+
+NOTIFICATIONS = 300
+
+class IncrementalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = generate_db(os.path.join(self.directory, "wpndatabase.db"), handlers=5,
+                                notifications=NOTIFICATIONS, seed=4)
+        self.state = os.path.join(self.directory, "state.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, *statements):
+        conn = sqlite3.connect(self.path)
+        try:
+            with conn:
+                for statement in statements:
+                    conn.execute(statement)
+        finally:
+            conn.close()
+
+    def run_ndjson(self):
+        result = os.path.join(self.directory, "result.ndjson")
+        run_incremental(self.path, result, FORMAT_NDJSON, self.state)
+        with open(result) as fp:
+            return [json.loads(line) for line in fp]
+
+    def run_json(self):
+        result = os.path.join(self.directory, "result.json")
+        run_incremental(self.path, result, FORMAT_JSON, self.state)
+        with open(result) as fp:
+            return json.load(fp)
+
+    def test_full_run_gives_row_ids(self):
+        records = self.run_ndjson()
+        self.assertEqual(records[1], {"RecordType": DELTA, "status": "full", "since": None})
+        notifications = [record for record in records if record["RecordType"] == "notification"]
+        self.assertEqual(sorted(record["RowId"] for record in notifications), list(range(1, NOTIFICATIONS + 1)))
+
+    def test_unchanged(self):
+        self.run_ndjson()
+        records = self.run_ndjson()
+        self.assertEqual(records[1], {"RecordType": DELTA, "status": "unchanged"})
+        self.assertEqual(len(records), 2)
+
+    def test_delta_lists_changed_and_removed_rows(self):
+        self.run_ndjson()
+        self.write('DELETE FROM Notification WHERE rowid = 11',
+                   'UPDATE Notification SET Type = "tile" WHERE rowid = 12',
+                   'UPDATE Notification SET Type = "tile" WHERE rowid = 200')
+        records = self.run_ndjson()
+        delta = records[1]
+        self.assertEqual(delta["status"], "delta")
+        self.assertEqual(delta["removed"], [11])
+        notifications = dict((record["RowId"], record) for record in records if record["RecordType"] == "notification")
+        # Only the ranges holding a changed row are written again, whole
+        self.assertEqual(sorted(notifications), [rowid for rowid in range(1, NOTIFICATIONS + 1) if rowid != 11 and
+                                                 rowid // FINGERPRINT_RANGE in (12 // FINGERPRINT_RANGE,
+                                                                                200 // FINGERPRINT_RANGE)])
+        self.assertEqual(delta["changed"], len(notifications))
+        self.assertEqual(notifications[12]["Type"], "tile")
+        self.assertEqual(notifications[200]["Type"], "tile")
+
+    def test_delta_in_json(self):
+        self.run_json()
+        self.write('DELETE FROM Notification WHERE rowid = 11',
+                   'INSERT INTO Notification (Id, HandlerId, Type, Payload, ArrivalTime) '
+                   'SELECT Id || "-new", HandlerId, Type, Payload, ArrivalTime + 1 FROM Notification WHERE rowid = 1')
+        data = self.run_json()
+        self.assertEqual(data[DELTA]["removed"], [11])
+        row_ids = set(notification["RowId"] for handler in data[ASSETS].values()
+                      for notification in handler["Notifications"])
+        self.assertIn(NOTIFICATIONS + 1, row_ids)
+        # The ranges without changes are left out
+        self.assertNotIn(FINGERPRINT_RANGE, row_ids)
+
+    def test_state_has_one_fingerprint_per_range(self):
+        self.run_ndjson()
+        with open(self.state) as fp:
+            state = json.load(fp)
+        fingerprints = state[os.path.abspath(self.path)][FINGERPRINTS]
+        self.assertEqual(len(fingerprints), NOTIFICATIONS // FINGERPRINT_RANGE + 1)
+
+if __name__ == "__main__":
+    unittest.main()
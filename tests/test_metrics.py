@@ -0,0 +1,82 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from NotifAnalyzer import read_db
+from NotifGenerator import generate_db
+from NotifMetrics import Metrics, load_metrics
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        if tracemalloc:
+            tracemalloc.stop()
+        shutil.rmtree(self.directory)
+
+    def save(self, metrics):
+        path = os.path.join(self.directory, metrics.name + ".json")
+        metrics.save(path)
+        return load_metrics(path)
+
+    def test_phases_and_counts(self):
+        metrics = Metrics("db")
+        with metrics.phase("read"):
+            pass
+        metrics.count("notifications", 3)
+        saved = self.save(metrics)
+        self.assertEqual([phase["Phase"] for phase in saved["Phases"]], ["read"])
+        self.assertNotIn("PeakMemory", saved["Phases"][0])
+        self.assertEqual(saved["Counts"], {"notifications": 3})
+
+    @unittest.skipUnless(tracemalloc and hasattr(tracemalloc, "reset_peak"), "needs tracemalloc.reset_peak")
+    def test_traced_phases_stop_tracing_when_saved(self):
+        metrics = Metrics("traced", trace_memory=True)
+        with metrics.phase("allocate"):
+            data = bytearray(10 ** 6)
+        self.assertTrue(tracemalloc.is_tracing())
+        saved = self.save(metrics)
+        self.assertGreaterEqual(saved["Phases"][0]["PeakMemory"], len(data))
+        # The next database of the same process is not traced
+        self.assertFalse(tracemalloc.is_tracing())
+        self.save(Metrics("untraced"))
+        self.assertFalse(tracemalloc.is_tracing())
+
+    @unittest.skipUnless(tracemalloc and hasattr(tracemalloc, "reset_peak"), "needs tracemalloc.reset_peak")
+    def test_tracing_started_elsewhere_is_left_on(self):
+        tracemalloc.start()
+        self.save(Metrics("traced", trace_memory=True))
+        self.assertTrue(tracemalloc.is_tracing())
+
+    def test_disabled_metrics_write_nothing(self):
+        metrics = Metrics("off", enabled=False, trace_memory=True)
+        with metrics.phase("read"):
+            pass
+        self.assertIsNone(self.save(metrics))
+        if tracemalloc:
+            self.assertFalse(tracemalloc.is_tracing())
+
+    def test_optional_phases_only_when_asked(self):
+        path = generate_db(os.path.join(self.directory, "wpndatabase.db"), handlers=3, notifications=20, seed=1)
+        metrics = Metrics("plain")
+        read_db(path, metrics=metrics)
+        phases = set(phase["Phase"] for phase in metrics.phases)
+        self.assertIn("process_assets", phases)
+        self.assertFalse(phases & {"wal", "recover"})
+        metrics = Metrics("all")
+        read_db(path, recover=True, workers=1, wal=True, metrics=metrics)
+        self.assertTrue(set(phase["Phase"] for phase in metrics.phases) >= {"wal", "recover"})
+
+if __name__ == "__main__":
+    unittest.main()
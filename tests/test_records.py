@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from NotifRecords import NotificationRecord, blob_text
+
+# Runs on Python 3 and on Jython (Python 2), where there is no str() of a BLOB to
+# compare with: both must give the text of the parser for the same bytes
+SAMPLE_COUNT = 20000
+SAMPLE_ALPHABET = bytearray(b"ab'\"\\\t\n\r\x00\x7f\x80\xff <>")
+# SHA-1 of the str() of the samples on Python 3, one per line
+SAMPLES_DIGEST = "9834b7787691cd24e918a5b2c16428653bf7760c"
+KNOWN = [
+    (b"", "b''"),
+    (b"<toast/>", "b'<toast/>'"),
+    (b"'", "b\"'\""),
+    (b'"', "b'\"'"),
+    (b"'\"", "b'\\'\"'"),
+    (b"\\", "b'\\\\'"),
+    (b"\t\n\r\x00\x7f\x80\xff", "b'\\t\\n\\r\\x00\\x7f\\x80\\xff'"),
+    (u"café".encode("utf-8"), "b'caf\\xc3\\xa9'"),
+]
+
+def samples(count=SAMPLE_COUNT, seed=1):
+    # A linear congruential generator, as random gives other numbers on Python 2 and 3
+    state = seed
+    result = []
+    for i in range(count):
+        state = (state * 1103515245 + 12345) & 0x7fffffff
+        values = bytearray()
+        for j in range((state >> 16) % 41):
+            state = (state * 1103515245 + 12345) & 0x7fffffff
+            values.append(SAMPLE_ALPHABET[(state >> 16) % len(SAMPLE_ALPHABET)])
+        result.append(bytes(values))
+    return result
+
+class BlobTextTest(unittest.TestCase):
+
+    def test_known_values(self):
+        for data, text in KNOWN:
+            self.assertEqual(blob_text(data), text)
+            self.assertEqual(blob_text(bytearray(data)), text)
+
+    def test_samples_digest(self):
+        text = "\n".join(blob_text(data) for data in samples())
+        self.assertEqual(hashlib.sha1(text.encode("utf-8")).hexdigest(), SAMPLES_DIGEST)
+
+    @unittest.skipIf(sys.version_info[0] < 3, "str() of bytes is the reference on Python 3 only")
+    def test_same_as_str(self):
+        for data in samples() + [bytes(range(256)), u"\U0001F600".encode("utf-8")]:
+            self.assertEqual(blob_text(data), str(data))
+
+    @unittest.skipIf(sys.version_info[0] < 3, "str() of bytes is the reference on Python 3 only")
+    def test_notification_payload_text(self):
+        record = NotificationRecord(b"<badge value='1'/>", "badge", None, None, "xml")
+        self.assertEqual(record["Payload"], blob_text(record.Payload))
+        self.assertEqual(record.to_dict()["Payload"], blob_text(record.Payload))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from NotifGenerator import generate_db
+from NotifWAL import CURRENT, DELETED, PREVIOUS_CHECKPOINT, SUPERSEDED, WAL_SUFFIX, read_wal
+
+QUERY_UPDATE_TYPE = 'UPDATE Notification SET Type = ? WHERE "Order" = ?'
+QUERY_UPDATE_PAYLOAD = 'UPDATE Notification SET Payload = ? WHERE "Order" = ?'
+QUERY_DELETE = 'DELETE FROM Notification WHERE "Order" = ?'
+
+class WALTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = generate_db(os.path.join(self.directory, "source.db"), handlers=5, notifications=50, seed=2)
+        self.path = os.path.join(self.directory, "wpndatabase.db")
+        self.conn = sqlite3.connect(self.source)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        # Frames stay in the WAL until the test checkpoints
+        self.conn.execute('PRAGMA wal_autocheckpoint = 0')
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.directory)
+
+    def write(self, query, *parameters):
+        with self.conn:
+            self.conn.execute(query, parameters)
+
+    def read(self):
+        # Copied while the connection is open, as closing it checkpoints the WAL
+        shutil.copy(self.source, self.path)
+        shutil.copy(self.source + WAL_SUFFIX, self.path + WAL_SUFFIX)
+        return read_wal(self.path)
+
+    def versions(self, wal, rowid):
+        for entry in wal["History"]:
+            if entry["Table"] == "Notification" and entry["RowId"] == rowid:
+                return [(version["State"], version["Record"]) for version in entry["Versions"]]
+        return []
+
+    def test_without_wal(self):
+        self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        shutil.copy(self.source, self.path)
+        self.assertIsNone(read_wal(self.path))
+
+    def test_current_and_superseded_versions(self):
+        self.write(QUERY_UPDATE_TYPE, "first", 10)
+        self.write(QUERY_UPDATE_TYPE, "second", 10)
+        versions = self.versions(self.read(), 10)
+        self.assertEqual([(state, record["Type"]) for state, record in versions],
+                         [(SUPERSEDED, "first"), (CURRENT, "second")])
+
+    def test_deleted_version(self):
+        self.write(QUERY_UPDATE_TYPE, "kept", 20)
+        self.write(QUERY_DELETE, 20)
+        versions = self.versions(self.read(), 20)
+        self.assertEqual([(state, record["Type"]) for state, record in versions], [(DELETED, "kept")])
+
+    def test_current_version_matches_database(self):
+        self.write(QUERY_UPDATE_TYPE, "first", 30)
+        wal = self.read()
+        row = self.conn.execute('SELECT Id, HandlerId, Type, Payload FROM Notification WHERE "Order" = 30').fetchone()
+        state, record = self.versions(wal, 30)[-1]
+        self.assertEqual(state, CURRENT)
+        self.assertEqual((record["Id"], record["HandlerId"], record["Type"], record["Payload"]), row)
+
+    def test_overflow_payloads(self):
+        # Payloads larger than a page continue on overflow pages, read from the
+        # frames of the same transaction or else from the database file
+        first = os.urandom(9000)
+        second = os.urandom(5000)
+        self.write(QUERY_UPDATE_PAYLOAD, first, 40)
+        self.write(QUERY_UPDATE_PAYLOAD, second, 40)
+        self.write(QUERY_UPDATE_TYPE, "moved", 40)
+        versions = self.versions(self.read(), 40)
+        self.assertEqual([(state, record["Payload"]) for state, record in versions],
+                         [(SUPERSEDED, first), (SUPERSEDED, second), (CURRENT, second)])
+
+    def test_previous_checkpoint_frames(self):
+        for order in range(1, 51):
+            self.write(QUERY_UPDATE_TYPE, "old", order)
+        # The next write restarts the WAL with new salts, over the start of the old frames
+        self.conn.execute('PRAGMA wal_checkpoint(RESTART)')
+        self.write(QUERY_UPDATE_TYPE, "new", 10)
+        wal = self.read()
+        self.assertEqual(len(wal["Index"]), 2)
+        states = set(version["State"] for entry in wal["History"] for version in entry["Versions"])
+        self.assertIn(PREVIOUS_CHECKPOINT, states)
+        # Versions are in log order, the stale frames of the old salts come after the new ones
+        current = [record["Type"] for state, record in self.versions(wal, 10) if state == CURRENT]
+        self.assertEqual(current, ["new"])
+
+if __name__ == "__main__":
+    unittest.main()